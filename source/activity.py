@@ -0,0 +1,73 @@
+from collections import deque, OrderedDict
+import threading
+import time
+
+class WindowCounter:
+    ''' number of events in the last `window` seconds. events are counted in n_buckets
+        time buckets with a running total, so add and count are amortized O(1)
+        (accurate to one bucket width).
+    '''
+    def __init__(self, window, n_buckets=60):
+        self.window = window
+        self.n_buckets = n_buckets
+        self.width = window / n_buckets
+        self._buckets = deque()  # [bucket index, count], oldest first
+        self.total = 0
+
+    def _expire(self, now):
+        oldest = int(now // self.width) - self.n_buckets + 1
+        while self._buckets and self._buckets[0][0] < oldest:
+            self.total -= self._buckets.popleft()[1]
+
+    def add(self, now):
+        index = int(now // self.width)
+        if self._buckets and self._buckets[-1][0] == index: self._buckets[-1][1] += 1
+        else: self._buckets.append([index, 1])
+        self.total += 1
+        self._expire(now)
+
+    def count(self, now):
+        self._expire(now)
+        return self.total
+
+class ChannelActivity:
+    ''' per channel message counts over sliding windows (1 min, 10 min, 1 hour).
+        channels without messages for idle_after seconds (default: the longest
+        window, when all their counts are 0 anyway) are dropped.
+        tracked on the event loop, counted on the inference thread: both under a lock.
+    '''
+    def __init__(self, windows=(60, 600, 3600), idle_after=None):
+        self.windows = tuple(windows)
+        self.idle_after = idle_after or max(self.windows)
+        self._channels = {}              # channel_id -> [WindowCounter per window]
+        self._last_seen = OrderedDict()  # channel_id -> last message time, least recent first
+        self._lock = threading.Lock()
+
+    def track(self, channel_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            counters = self._channels.get(channel_id)
+            if counters is None:
+                counters = self._channels[channel_id] = [WindowCounter(w) for w in self.windows]
+            for counter in counters: counter.add(now)
+            self._last_seen[channel_id] = now
+            self._last_seen.move_to_end(channel_id)
+            self._evict_idle(now)
+
+    def counts(self, channel_id, now=None):
+        '''message count per window, oldest window last (0s for unknown channels)'''
+        now = time.time() if now is None else now
+        with self._lock:
+            counters = self._channels.get(channel_id)
+            if counters is None: return (0,) * len(self.windows)
+            return tuple(counter.count(now) for counter in counters)
+
+    def _evict_idle(self, now):
+        while self._last_seen:
+            channel_id, last_seen = next(iter(self._last_seen.items()))
+            if now - last_seen <= self.idle_after: break
+            del self._last_seen[channel_id]
+            del self._channels[channel_id]
+
+    def __len__(self):
+        return len(self._channels)
@@ -5,10 +5,9 @@ import hashlib
 import importlib
 
 class ResponseAdder(commands.Cog):
-    def __init__(self, bot, ocky_bot, data):
+    def __init__(self, bot, ocky_bot):
         self.bot = bot # (discord bot instance)
         self.ocky_bot = ocky_bot # (OCKY_bot instance) 
-        self.data = data
         self.config = ocky_bot.config
         self.responses_file = ocky_bot.config.get('response_file', 'responses.json')
         self.setup_commands()
@@ -24,8 +23,12 @@ class ResponseAdder(commands.Cog):
             '''Add a new response to the bot'''
             await interaction.response.defer(ephemeral=True) # make response private
 
-            # load current responses
-            data = self.ocky_bot.responses
+            # load current responses (of this guild, in guild mode)
+            context = await self.ocky_bot.get_context(interaction.guild_id)
+            if context is None:
+                await interaction.followup.send("! OCKY isn't set up for this server", ephemeral=True)
+                return
+            data = context.responses
 
             # initialize category if it doesn't exist
             if category not in data:
@@ -39,18 +42,20 @@ class ResponseAdder(commands.Cog):
             
             # add the response to the responses object and save back to file
             data[category]['responses'].append(response)
-            self.data.save_responses(data)
+            context.data_manager.save_responses(data)
 
             # add embedding to this response manually
             response_hash = hashlib.md5(response.encode('utf-8')).hexdigest()[:10]
             response_id = (category, response_hash)
             
-            # create embedding and save
-            embeddings = self.ocky_bot.choice_system.response_embeddings
-            new_embedding = self.ocky_bot.sentence_model.encode(example_input)
-            embeddings[response_id] = new_embedding
-            self.ocky_bot.choice_system.response_dict[response_id] = response
-            succes = self.data.save_model(self.ocky_bot.choice_system.response_embeddings, 'response_embeddings.pkl')
+            # create embedding and save (on the inference thread: encoding blocks, and the
+            # embeddings are searched there)
+            def add_embedding():
+                embeddings = context.choice_system.response_embeddings
+                embeddings[response_id] = self.ocky_bot.sentence_model.encode(example_input, persist=True)
+                context.choice_system.response_dict[response_id] = response
+                return context.data_manager.save_checkpoint(embeddings=embeddings)
+            succes = await self.ocky_bot.inference.run(add_embedding)
             
             message = f"! Added response to category '{category}'" if succes else "! Failed to save responses file"
             await interaction.followup.send(message, ephemeral=True)
@@ -61,7 +66,11 @@ class ResponseAdder(commands.Cog):
             '''List all available categories'''
             await interaction.response.defer(ephemeral=True)
 
-            data = self.ocky_bot.responses
+            context = await self.ocky_bot.get_context(interaction.guild_id)
+            if context is None:
+                await interaction.followup.send("! OCKY isn't set up for this server", ephemeral=True)
+                return
+            data = context.responses
             embed = discord.Embed(title="Response Categories", color=0x00ff00)
 
             for category, category_data in data.items():
@@ -79,7 +88,7 @@ class ResponseAdder(commands.Cog):
         @app_commands.describe(module="what module to reload")
         async def ocky_reloader(interaction: discord.Interaction, module:str="training"):
             await interaction.response.defer(ephemeral=True)
-            self.ocky_bot.reload(module)
-            await interaction.followup.send(f"reloaded {module}!", ephemeral=True)
+            if await self.ocky_bot.reload(module): await interaction.followup.send(f"reloaded {module}!", ephemeral=True)
+            else: await interaction.followup.send(f"! unknown module '{module}' (response, choice, training, data)", ephemeral=True)
                     
 
@@ -0,0 +1,606 @@
+''' offline benchmarks for OCKY. run from the repo root:
+        python source/benchmark.py ann
+        python source/benchmark.py startup
+        python source/benchmark.py train
+        python source/benchmark.py pipeline [--events stream.jsonl]
+        python source/benchmark.py encoders [--backends torch onnx-int8]
+
+    pipeline replays a message/reaction stream through the whole bot, one JSON event per line:
+        {"type": "message", "id": 1, "channel": 1, "author": 7, "content": "hoi", "mentions_bot": false}
+        {"type": "reaction", "message": 1, "emoji": "🗣️", "user": 8}     (on a user message)
+        {"type": "reaction", "reply_to": 1, "emoji": "👍", "user": 8}    (on the bot's reply to message 1)
+    channel 1 is the bot channel. messages can have a "guild" (for guild mode, --guilds).
+    without --events a synthetic stream is generated.
+'''
+import argparse
+import asyncio
+import datetime
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+import numpy as np
+from embed_index import EmbeddingIndex, IVFIndex
+from choice_sys import ChoiceSystem
+from training import apply_choice_feedback, TrainingManager
+from response_sys import ResponseSystem
+from data import DataManager
+from transformer_ram import process_rss_mb, make_model_factory, ENCODER_BACKENDS
+from metrics import metrics
+
+class StandInEncoder:
+    ''' small local replacement for the sentence model, so benchmarks run without
+        downloading MiniLM: hashed bag of words, with a simulated cost per encode
+        call and per sentence (roughly MiniLM on a small CPU by default)
+    '''
+    def __init__(self, dim=384, call_ms=15.0, item_ms=2.0):
+        self.dim = dim
+        self.call_ms = call_ms
+        self.item_ms = item_ms
+        self.calls = 0
+        self.items = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.dim] += 1.0
+            vector[int.from_bytes(digest[4:8], 'little') % self.dim] -= 0.5
+        return vector
+
+    def encode(self, sentences, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        self.calls += 1
+        self.items += len(sentences)
+        time.sleep((self.call_ms + self.item_ms * len(sentences)) / 1000)
+        embeddings = np.array([self._embed(s) for s in sentences], dtype=np.float32).reshape(len(sentences), self.dim)
+        return embeddings[0] if single else embeddings
+
+class ColdStartData:
+    '''data manager stand-in without any saved embeddings (cold start)'''
+    def load_response_embeddings(self):
+        return {}
+
+def synthetic_embeddings(n, dim, n_topics, rng):
+    '''clustered fake sentence embeddings: a topic direction plus noise per row'''
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    labels = rng.integers(0, n_topics, n)
+    return topics[labels] + 1.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+def timed_queries(index, queries, k):
+    start = time.perf_counter()
+    results = [[rid for rid, _ in index.search(q, k)] for q in queries]
+    return results, (time.perf_counter() - start) / len(queries)
+
+def bench_ann(args):
+    '''recall vs latency of the IVF index against exact (flat) search'''
+    rng = np.random.default_rng(0)
+    data = synthetic_embeddings(args.n, args.dim, args.topics, rng)
+    queries = data[rng.choice(args.n, args.queries, replace=False)] + 1.0 * rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+
+    flat = EmbeddingIndex(args.dim, capacity=args.n)
+    ivf = IVFIndex(args.dim, capacity=args.n, n_lists=args.lists, min_size=0)
+    for i, vector in enumerate(data):
+        flat[i] = vector
+        ivf[i] = vector
+
+    start = time.perf_counter()
+    ivf.train()
+    print(f"{args.n} x {args.dim}, IVF build ({len(ivf.centroids)} lists): {time.perf_counter() - start:.2f}s")
+
+    exact, flat_latency = timed_queries(flat, queries, args.k)
+    print(f"flat        recall@{args.k} 1.000  {flat_latency * 1000:.3f} ms/query")
+    for n_probe in args.probes:
+        ivf.n_probe = n_probe
+        approx, latency = timed_queries(ivf, queries, args.k)
+        recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approx, exact)])
+        print(f"ivf probe {n_probe:<3} recall@{args.k} {recall:.3f}  {latency * 1000:.3f} ms/query  ({flat_latency / latency:.1f}x)")
+
+    # incremental insert / in-place update cost
+    start = time.perf_counter()
+    for i in range(1000): ivf[args.n + i] = data[i]
+    print(f"ivf insert: {(time.perf_counter() - start):.3f} ms/insert")
+    start = time.perf_counter()
+    for i in range(1000): ivf[i] = data[i] + 0.1
+    print(f"ivf update: {(time.perf_counter() - start):.3f} ms/update")
+
+def legacy_load_embeddings(responses, sentence_model):
+    '''the old startup: one encode per response'''
+    embeddings = {}
+    for category, category_data in responses.items():
+        example_input = category_data.get('example_input')
+        for response in category_data.get('responses', []):
+            response_id = (category, hashlib.md5(response.encode('utf-8')).hexdigest()[:10])
+            if example_input != 'None': embeddings[response_id] = sentence_model.encode(example_input)
+            else: embeddings[response_id] = sentence_model.encode(response)
+    return embeddings
+
+def bench_startup(args):
+    '''cold start of the choice system embeddings, old per-response vs batched'''
+    with open(args.responses, 'r', encoding='utf-8') as f:
+        responses = json.load(f)
+    config = {'randomness': 0.05}
+
+    encoder = StandInEncoder(call_ms=args.call_ms, item_ms=args.item_ms)
+    start = time.perf_counter()
+    legacy_load_embeddings(responses, encoder)
+    print(f"per-response: {time.perf_counter() - start:.2f}s, {encoder.calls} encode calls, {encoder.items} sentences")
+
+    encoder = StandInEncoder(call_ms=args.call_ms, item_ms=args.item_ms)
+    start = time.perf_counter()
+    ChoiceSystem(config, ColdStartData(), encoder, responses)
+    print(f"batched:      {time.perf_counter() - start:.2f}s, {encoder.calls} encode calls, {encoder.items} sentences")
+
+def legacy_train_choice(embeddings, datapoints, learning_rate):
+    '''the old choice training: one datapoint at a time, scanning all responses for siblings'''
+    for data in datapoints:
+        if data['feedback_score'] == 0: continue
+        response_id = data['response_id']
+        feedback = data['feedback_score']
+        input_embedding = data['original_embedding']
+        if response_id not in embeddings: continue
+
+        current_embedding = embeddings[response_id]
+        mu = learning_rate * (input_embedding - current_embedding)
+        embeddings[response_id] = current_embedding + mu if feedback > 0 else current_embedding - mu
+
+        for other_response_id in embeddings:
+            if (other_response_id[0] != response_id[0]) or (other_response_id == response_id): continue
+            other_embedding = embeddings[other_response_id]
+            mu = 0.5 * learning_rate * (input_embedding - other_embedding)
+            embeddings[other_response_id] = other_embedding + mu if feedback > 0 else other_embedding - mu
+
+def bench_train(args):
+    '''hourly choice training: sequential loop vs grouped numpy update'''
+    rng = np.random.default_rng(0)
+    data = synthetic_embeddings(args.responses, args.dim, args.categories, rng)
+    ids = [(f'category{i % args.categories}', f'{i:010x}') for i in range(args.responses)]
+    records = [{'response_id': ids[i]} for i in rng.integers(0, args.responses, args.feedback)]
+    inputs = synthetic_embeddings(args.feedback, args.dim, args.categories, rng)
+    feedback = rng.choice([-1.5, -1.0, 1.0, 1.5], args.feedback).astype(np.float32)
+
+    def fresh_index():
+        index = EmbeddingIndex(args.dim, capacity=args.responses)
+        for response_id, vector in zip(ids, data): index[response_id] = vector
+        return index
+
+    # vectorized, full size
+    index = fresh_index()
+    start = time.perf_counter()
+    apply_choice_feedback(index, records, inputs, feedback, args.learning_rate)
+    print(f"grouped numpy: {args.feedback} feedback x {args.responses} responses in {time.perf_counter() - start:.2f}s")
+
+    # sequential, on a prefix (it's far too slow for the full set), checked against the vectorized one
+    n = min(args.legacy_feedback, args.feedback)
+    legacy, grouped = fresh_index(), fresh_index()
+    start = time.perf_counter()
+    legacy_train_choice(legacy, [dict(r, original_embedding=x, feedback_score=f) for r, x, f in zip(records[:n], inputs[:n], feedback[:n])], args.learning_rate)
+    elapsed = time.perf_counter() - start
+    print(f"sequential:    {n} feedback in {elapsed:.2f}s (~{elapsed * args.feedback / n:.0f}s extrapolated to {args.feedback})")
+    apply_choice_feedback(grouped, records[:n], inputs[:n], feedback[:n], args.learning_rate)
+    print(f"max abs difference on those {n}: {np.abs(legacy.matrix - grouped.matrix).max():.2e}")
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f'user{user_id}'
+
+    def __str__(self):
+        return self.name
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeChannel:
+    ''' discord channel stand-in, one per message: remembers the bot's reply to that
+        message (in replies) so later reactions can be put on it
+    '''
+    def __init__(self, channel_id, stream, origin_id=None):
+        self.id = channel_id
+        self.stream = stream
+        self.origin_id = origin_id
+
+    async def send(self, content):
+        await asyncio.sleep(self.stream.api_ms / 1000)
+        origin = self.stream.by_id.get(self.origin_id)
+        sent = FakeMessage(self.stream.next_id(), self.id, self.stream.bot_user, content, self.stream, guild=origin.guild if origin else None)
+        if self.origin_id is not None:
+            self.stream.replies[self.origin_id] = sent
+            if origin is not None:
+                requested_at = self.stream.forced.pop(self.origin_id, origin.created_at)
+                self.stream.reply_latency.append((sent.created_at - requested_at).total_seconds())
+        return sent
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.stream.api_ms / 1000)
+
+class FakeMessage:
+    '''discord.Message stand-in with what the bot reads from it'''
+    def __init__(self, message_id, channel_id, author, content, stream, mentions=(), guild=None):
+        self.id = message_id
+        self.guild = guild
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+        self.channel = FakeChannel(channel_id, stream, message_id)
+        self.stream = stream
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.stream.api_ms / 1000)
+
+class FakeReaction:
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+
+class ReplayStream:
+    '''turns events into fake discord objects, keeping track of the messages sent so far'''
+    def __init__(self, bot_user, channel_id, api_ms=0.0):
+        self.bot_user = bot_user
+        self.channel_id = channel_id
+        self.api_ms = api_ms
+        self.messages = {}  # event message id -> FakeMessage
+        self.replies = {}   # FakeMessage id -> the bot's reply
+        self.by_id = {}     # FakeMessage id -> user message
+        self.reply_latency = []  # seconds, user message (or 🗣️ on it) -> bot reply
+        self.forced = {}    # FakeMessage id -> when a 🗣️ asked for a reply to it
+        self.users = {}
+        self._next_id = 10**12
+
+    def next_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def user(self, user_id):
+        if user_id not in self.users: self.users[user_id] = FakeUser(user_id)
+        return self.users[user_id]
+
+    def message(self, event):
+        channel = self.channel_id if event.get('channel', 1) == 1 else event['channel']
+        mentions = [self.bot_user] if event.get('mentions_bot') else []
+        guild = FakeGuild(event['guild']) if event.get('guild') is not None else None
+        message = FakeMessage(self.next_id(), channel, self.user(event.get('author', 0)), event['content'], self, mentions, guild)
+        self.messages[event['id']] = message
+        self.by_id[message.id] = message
+        return message
+
+    def reaction(self, event):
+        '''(reaction, user), None if the message it's on never existed (e.g. the bot didn't reply)'''
+        if 'reply_to' in event:
+            # replies are kept under the id of the FakeMessage they answer, not the event id
+            original = self.messages.get(event['reply_to'])
+            message = self.replies.get(original.id) if original is not None else None
+        else: message = self.messages.get(event['message'])
+        if message is None: return None
+        if event['emoji'] == '🗣️': self.forced[message.id] = datetime.datetime.now(datetime.timezone.utc)
+        return FakeReaction(message, event['emoji']), self.user(event.get('user', 0))
+
+def synthetic_events(n_messages, n_channels, seed=0, n_guilds=0):
+    ''' chat-like stream: short messages from a small vocabulary, some questions and
+        mentions, 🗣️ on a part of them (mostly questions / mentions) and feedback on replies
+    '''
+    rng = np.random.default_rng(seed)
+    words = ('hoi lol ocky wat hoe waarom dan echt niet wel ja nee gaan doen morgen vandaag '
+             'eten school game spelen kijken leuk saai mooi raar jij ik wij zij nu weer').split()
+    events = []
+    for message_id in range(1, n_messages + 1):
+        question = rng.random() < 0.2
+        mention = rng.random() < 0.1
+        content = ' '.join(rng.choice(words, rng.integers(1, 12))) + ('?' if question else '')
+        events.append({
+            'type': 'message', 'id': message_id, 'channel': int(rng.integers(1, n_channels + 1)) if rng.random() < 0.3 else 1,
+            'author': int(rng.integers(1, 20)), 'content': content, 'mentions_bot': bool(mention),
+            'guild': int(rng.integers(1, n_guilds + 1)) if n_guilds else None
+        })
+        if rng.random() < (0.6 if question or mention else 0.05):
+            events.append({'type': 'reaction', 'message': message_id, 'emoji': '🗣️', 'user': int(rng.integers(1, 20))})
+        if rng.random() < 0.5:
+            events.append({'type': 'reaction', 'reply_to': message_id, 'emoji': str(rng.choice(['👍', '👎', '🟩', '🟥'])), 'user': int(rng.integers(1, 20))})
+    return events
+
+def load_events(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def time_method(latencies, stage, cls, name):
+    '''timed() on a class, so it covers every instance (every guild's systems)'''
+    setattr(cls, name, timed(latencies, stage, getattr(cls, name)))
+
+def timed(latencies, stage, fn):
+    '''wrap a (sync or async) method so each call's latency goes into latencies[stage]'''
+    if asyncio.iscoroutinefunction(fn):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try: return await fn(*args, **kwargs)
+            finally: latencies[stage].append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try: return fn(*args, **kwargs)
+            finally: latencies[stage].append(time.perf_counter() - start)
+    return wrapper
+
+async def replay(bot, events, args):
+    '''feed the events through the bot's event handlers, returns (latencies, elapsed, peak rss)'''
+    handler = bot.discord_handler
+    stream = ReplayStream(bot.bot.user, handler.channel_id, args.api_ms)
+    latencies = defaultdict(list)
+
+    # per stage timers
+    time_method(latencies, 'should_respond', ResponseSystem, 'should_respond')
+    bot.batcher.encode = timed(latencies, 'encode', bot.batcher.encode)
+    time_method(latencies, 'get_response', ChoiceSystem, 'get_response')
+    handler.send_response = timed(latencies, 'send_response', handler.send_response)
+    time_method(latencies, 'feedback', DataManager, 'process_feedback')
+    time_method(latencies, 'training', TrainingManager, '_training_run')
+    on_message = timed(latencies, 'on_message', bot.bot.on_message)
+    on_reaction_add = timed(latencies, 'on_reaction_add', bot.bot.on_reaction_add)
+
+    # peak memory, sampled
+    peak = [process_rss_mb() or 0.0]
+    async def sample_rss():
+        while True:
+            peak[0] = max(peak[0], process_rss_mb() or 0.0)
+            await asyncio.sleep(0.05)
+    sampler = asyncio.ensure_future(sample_rss())
+
+    async def dispatch(event):
+        if event['type'] == 'message':
+            await on_message(stream.message(event))
+        elif event['type'] == 'reaction':
+            reaction = stream.reaction(event)
+            if reaction is not None: await on_reaction_add(*reaction)
+
+    background = []
+    start = time.perf_counter()
+    for i, event in enumerate(events):
+        if args.rate > 0:
+            # open loop: events arrive on schedule, whether or not the bot keeps up
+            await asyncio.sleep(max(0.0, start + i / args.rate - time.perf_counter()))
+            background.append(asyncio.ensure_future(dispatch(event)))
+        else: await dispatch(event)
+        if args.train_every and (i + 1) % args.train_every == 0:
+            for context in bot.contexts():
+                background.append(asyncio.ensure_future(
+                    context.training_manager.training_loop(context)
+                ))
+    await asyncio.gather(*background)
+    elapsed = time.perf_counter() - start
+    latencies['reply'] = stream.reply_latency
+    await handler.reactions.join()  # seed reactions still queued (not part of the replay time)
+
+    sampler.cancel()
+    peak[0] = max(peak[0], process_rss_mb() or 0.0)
+    return latencies, elapsed, peak[0]
+
+@contextlib.contextmanager
+def quiet_children(quiet=True):
+    '''point fd 1 at devnull too: the (spawned) training process prints to it, not to sys.stdout'''
+    if not quiet:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull: os.dup2(devnull.fileno(), 1)
+    try: yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def bench_pipeline(args):
+    '''replay a message/reaction stream through the full bot with the stand-in encoder'''
+    from main import OCKYBot
+    events = load_events(args.events) if args.events else synthetic_events(args.messages, args.channels, args.seed, args.guilds)
+
+    def load_encoder(model_name):
+        time.sleep(args.load_ms / 1000)
+        return StandInEncoder(call_ms=args.call_ms, item_ms=args.item_ms)
+
+    with tempfile.TemporaryDirectory() as models_dir:
+        config = {
+            'channel': 1, 'training': 0, 'forceful_react_emote': '🗣️', 'randomness': 0.05,
+            'learning_rate': 0.1, 'ram_friendly': 1, 'response_file': args.responses,
+            'models_dir': models_dir, 'feedback_log': args.feedback_log,
+            'training_process': args.training_process, 'feedback_window': 0,
+            'model_idle_timeout': args.idle_timeout, 'metrics': int(args.metrics is not None),
+            'reaction_interval': args.reaction_interval
+        }
+        if args.guilds: config['guilds'] = {'*': {}}
+        rss_before = process_rss_mb()
+        output = sys.stdout if args.verbose else open(os.devnull, 'w')
+        with contextlib.redirect_stdout(output), quiet_children(not args.verbose):
+            bot = OCKYBot(config=config, model_factory=load_encoder)
+            bot.bot._connection.user = FakeUser(0, bot=True)
+            latencies, elapsed, peak_rss = asyncio.run(replay(bot, events, args))
+            if args.metrics: metrics.dump_json(args.metrics)
+            contexts = bot.contexts()
+            bot.inference.shutdown()
+            if bot.guilds is not None: bot.guilds.shutdown()
+            else:
+                bot.training_manager.shutdown()
+                bot.data_manager.close()
+        if output is not sys.stdout: output.close()
+
+    n_messages = sum(event['type'] == 'message' for event in events)
+    print(f"{len(events)} events ({n_messages} messages) in {elapsed:.2f}s: "
+          f"{len(events) / elapsed:.1f} events/s, {n_messages / elapsed:.1f} messages/s")
+    print(f"{'stage':<16}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in ('on_message', 'should_respond', 'encode', 'get_response', 'send_response', 'reply',
+                  'on_reaction_add', 'feedback', 'training'):
+        if not latencies[stage]: continue
+        p50, p95, p99, top = np.percentile(np.array(latencies[stage]) * 1000, [50, 95, 99, 100])
+        print(f"{stage:<16}{len(latencies[stage]):>7}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{top:>10.2f}")
+
+    model = bot.sentence_model.stats()
+    print(f"peak RSS {peak_rss:.0f} MB (start {rss_before or 0:.0f} MB)")
+    print(f"model loads {model['load_count']}, unloads {model['unload_count']}, "
+          f"embedding cache hit rate {model['cache']['hit_rate']:.2f}")
+    decisions, store = defaultdict(int), defaultdict(int)
+    for context in contexts:
+        for stage, n in context.response_system.stage_counts.items(): decisions[stage] += n
+        for kind, n in context.data_manager.store.stats().items(): store[kind] += n
+    if bot.guilds is not None: print(f"guilds loaded at the end: {len(contexts)}")
+    print(f"decisions {dict(decisions)}")
+    print(f"reactions {bot.discord_handler.reactions.stats()}")
+    print(f"inference {bot.inference.stats()}, training runs {sum(c.training_manager.runs for c in contexts)}, "
+          f"store {dict(store)}")
+
+def measure_backend(backend, model_name, sentences, queries, export_dir, quantization):
+    '''in a fresh process: load time, memory and encode latency of one encoder backend, plus its embeddings'''
+    rss_start = process_rss_mb() or 0.0
+    start = time.perf_counter()
+    model = make_model_factory(backend, export_dir, quantization)(model_name)
+    load_time = time.perf_counter() - start
+    rss_loaded = process_rss_mb() or 0.0
+
+    model.encode(sentences[:8])  # warm up
+    single = []
+    for query in queries:
+        start = time.perf_counter()
+        model.encode(query)
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    embeddings = model.encode(sentences, batch_size=64)
+    batch_time = time.perf_counter() - start
+    return {
+        'load_time': load_time,
+        'rss': rss_loaded - rss_start,
+        'peak_rss': max(rss_loaded, process_rss_mb() or 0.0) - rss_start,
+        'single_ms': np.percentile(np.array(single) * 1000, [50, 95]),
+        'batch_ms': batch_time * 1000 / len(sentences),
+        'embeddings': np.asarray(embeddings, dtype=np.float32),
+        'query_embeddings': np.asarray(model.encode(queries, batch_size=64), dtype=np.float32)
+    }
+
+def normalized(matrix):
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=-1, keepdims=True), 1e-12)
+
+def equivalence(reference, result):
+    '''(cosine of each embedding to the reference one, fraction of queries with the same top-1 response)'''
+    cosine = np.sum(normalized(result['embeddings']) * normalized(reference['embeddings']), axis=1)
+    reference_choice = np.argmax(normalized(reference['query_embeddings']) @ normalized(reference['embeddings']).T, axis=1)
+    choice = np.argmax(normalized(result['query_embeddings']) @ normalized(result['embeddings']).T, axis=1)
+    return cosine, np.mean(choice == reference_choice)
+
+def bench_encoders(args):
+    ''' encoder backends against the original pytorch model: load time, resident memory and
+        encode latency each, and whether they're equivalent: cosine of each embedding to the
+        torch one, and how often the choice system would pick the same response.
+        an equivalence test too: exit status 1 if a backend's lowest cosine is under
+        --min-cosine, or if torch or a requested backend can't run (unless --allow-missing)
+    '''
+    with open(args.responses, 'r', encoding='utf-8') as f:
+        responses = json.load(f)
+    sentences = sorted({text for category in responses.values() for text in
+                        category.get('responses', []) + [category.get('example_input', 'None')] if text != 'None'})
+    queries = [event['content'] for event in synthetic_events(args.queries, 1, args.seed) if event['type'] == 'message']
+
+    results = {}
+    for backend in ['torch'] + [b for b in args.backends if b != 'torch']:
+        # own process per backend, so memory is measured from a clean start
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            try:
+                results[backend] = pool.submit(
+                    measure_backend, backend, args.model, sentences, queries, args.export_dir, args.quantization
+                ).result()
+            except Exception as e:
+                print(f"{backend:<11} unavailable: {e}")
+    missing = [backend for backend in dict.fromkeys(['torch'] + list(args.backends)) if backend not in results]
+
+    if 'torch' not in results:
+        print("no torch reference, can't check equivalence")
+        return 0 if args.allow_missing else 1
+    reference = results['torch']
+
+    print(f"{len(sentences)} response texts, {len(queries)} queries, model {args.model}, tolerance: min cosine >= {args.min_cosine}")
+    print(f"{'backend':<11}{'load s':>8}{'RSS MB':>8}{'peak MB':>9}{'p50 ms':>8}{'p95 ms':>8}{'batch ms':>10}{'min cos':>9}{'mean cos':>10}{'same top1':>11}")
+    failed = []
+    for backend, result in results.items():
+        cosine, same_top1 = equivalence(reference, result)
+        print(f"{backend:<11}{result['load_time']:>8.2f}{result['rss']:>8.0f}{result['peak_rss']:>9.0f}"
+              f"{result['single_ms'][0]:>8.2f}{result['single_ms'][1]:>8.2f}{result['batch_ms']:>10.3f}"
+              f"{cosine.min():>9.4f}{cosine.mean():>10.4f}{same_top1:>11.3f}")
+        if cosine.min() < args.min_cosine:
+            print(f"  ! {backend} is not equivalent: cosine {cosine.min():.4f} < {args.min_cosine}")
+            failed.append(backend)
+
+    if missing and not args.allow_missing: print(f"FAIL: couldn't run {', '.join(missing)}")
+    if failed: print(f"FAIL: below tolerance: {', '.join(failed)}")
+    if failed or (missing and not args.allow_missing): return 1
+    print(f"PASS: {', '.join(b for b in results if b != 'torch') or 'torch only'} within tolerance")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCKY offline benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ann = commands.add_parser('ann', help="approximate vs exact response search")
+    ann.add_argument('--n', type=int, default=100_000)
+    ann.add_argument('--dim', type=int, default=384)
+    ann.add_argument('--topics', type=int, default=500)
+    ann.add_argument('--lists', type=int, default=None)
+    ann.add_argument('--probes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    ann.add_argument('--queries', type=int, default=200)
+    ann.add_argument('--k', type=int, default=5)
+    ann.set_defaults(func=bench_ann)
+
+    startup = commands.add_parser('startup', help="cold start embedding of responses.json")
+    startup.add_argument('--responses', default='responses.json')
+    startup.add_argument('--call-ms', type=float, default=15.0)
+    startup.add_argument('--item-ms', type=float, default=2.0)
+    startup.set_defaults(func=bench_startup)
+
+    train = commands.add_parser('train', help="choice system training update")
+    train.add_argument('--responses', type=int, default=5000)
+    train.add_argument('--feedback', type=int, default=10_000)
+    train.add_argument('--categories', type=int, default=30)
+    train.add_argument('--dim', type=int, default=384)
+    train.add_argument('--learning-rate', type=float, default=0.1)
+    train.add_argument('--legacy-feedback', type=int, default=20)
+    train.set_defaults(func=bench_train)
+
+    pipeline = commands.add_parser('pipeline', help="replay a message stream through the full bot")
+    pipeline.add_argument('--events', default=None, help="JSONL event stream (default: synthetic)")
+    pipeline.add_argument('--messages', type=int, default=2000)
+    pipeline.add_argument('--channels', type=int, default=3)
+    pipeline.add_argument('--guilds', type=int, default=0, help="spread the synthetic stream over this many guilds (guild mode)")
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--rate', type=float, default=0, help="events/s, 0: one after the other")
+    pipeline.add_argument('--train-every', type=int, default=500, help="events between training runs, 0: never")
+    pipeline.add_argument('--responses', default='responses.json')
+    pipeline.add_argument('--call-ms', type=float, default=15.0)
+    pipeline.add_argument('--item-ms', type=float, default=2.0)
+    pipeline.add_argument('--load-ms', type=float, default=500.0)
+    pipeline.add_argument('--api-ms', type=float, default=0.0, help="simulated discord API latency")
+    pipeline.add_argument('--reaction-interval', type=float, default=0.0, help="seconds between seed reactions per channel (bot default 0.25)")
+    pipeline.add_argument('--idle-timeout', type=float, default=300)
+    pipeline.add_argument('--feedback-log', type=int, default=1)
+    pipeline.add_argument('--training-process', type=int, default=1)
+    pipeline.add_argument('--metrics', default=None, help="turn metrics on and dump them to this JSON file")
+    pipeline.add_argument('--verbose', action='store_true')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    encoders = commands.add_parser('encoders', help="encoder backends: speed, memory and equivalence to torch")
+    encoders.add_argument('--backends', nargs='+', default=ENCODER_BACKENDS, choices=ENCODER_BACKENDS)
+    encoders.add_argument('--model', default='paraphrase-multilingual-MiniLM-L12-v2')
+    encoders.add_argument('--responses', default='responses.json')
+    encoders.add_argument('--queries', type=int, default=200)
+    encoders.add_argument('--seed', type=int, default=0)
+    encoders.add_argument('--export-dir', default='source/models/encoders')
+    encoders.add_argument('--quantization', default='avx2')
+    encoders.add_argument('--min-cosine', type=float, default=0.98, help="lowest cosine to torch a backend may have")
+    encoders.add_argument('--allow-missing', action='store_true', help="backends that can't run (not installed) don't fail the check")
+    encoders.set_defaults(func=bench_encoders)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
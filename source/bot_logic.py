@@ -3,36 +3,58 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 from add_response import ResponseAdder
+from inference import Overloaded
+from metrics import metrics, MetricsServer
+from feedback import EMOJI_SCORES
+from reactions import ReactionQueue
 import asyncio
 
 class DiscordHandler():
     ''' handles all logic pertaining to discord communications (receiving/sending information to the server).
     '''
-    def __init__(self, config, data_manager, ocky_bot):
+    def __init__(self, config, ocky_bot):
         # vars
         self.config = config
         self.is_training = config.get('training', 0) == 1
         self.channel_id = self.config.get('channel')
-        self.data_manager = data_manager
         self.ocky_bot = ocky_bot  # Reference to main bot instance
+        self.metrics_server = None
+        self.reactions = ReactionQueue(config.get('reaction_interval', 0.25), config.get('max_pending_reactions', 500))
 
-        # bot setup
+        # bot setup. shard_id/shard_count: this process is one of several shards
         intents = discord.Intents.all()
-        self.bot = commands.Bot(command_prefix='!', intents=intents)
+        self.bot = commands.Bot(
+            command_prefix='!', intents=intents,
+            shard_id=config.get('shard_id'), shard_count=config.get('shard_count')
+        )
         self._setup_events()
-    
-    async def send_response(self, message, response):
-        print(f"responding with {response['text']}")
-        sent_message = await message.channel.send(response['text'])
 
-        # react self
-        for emoji in ['🟩','👍','👎','🟥']: await sent_message.add_reaction(emoji)
+    async def send_response(self, context, message, response, requested_at=None):
+        ''' send the reply and return: the seed reactions are added in the background.
+            requested_at: when the reply was asked for, for ocky_reply_seconds (the message's
+            created_at by default; a reply forced by a reaction counts from the reaction).
+            the training record reuses the embedding the choice system computed, so it's an
+            in-memory insert (its log write happens on the log's writer thread). it's made
+            right after sending, before any reaction on the reply can come in. the store is
+            written from here and the inference thread, under its lock (see RecordCollection).
+        '''
+        print(f"responding with {response['text']}")
+        with metrics.timer('ocky_send_seconds'):
+            sent_message = await message.channel.send(response['text'])
+        if requested_at is None: requested_at = getattr(message, 'created_at', None)
+        if requested_at is not None and getattr(sent_message, 'created_at', None) is not None:
+            # user message -> bot reply, by discord's own timestamps
+            metrics.observe('ocky_reply_seconds', (sent_message.created_at - requested_at).total_seconds())
 
         # track data for this response
-        self.data_manager.prev_response[message.channel.id] = time.time()
-        self.data_manager.record_bot_response(
-            message, sent_message, response['id'], self.ocky_bot.sentence_model
-        )
+        context.data_manager.prev_response[message.channel.id] = time.time()
+        embedding = response.get('embedding')
+        if embedding is None:
+            embedding = await self.ocky_bot.inference.run(self.ocky_bot.sentence_model.encode, message.content)
+        context.data_manager.record_bot_response(message, sent_message, response['id'], embedding)
+
+        # react self
+        self.reactions.add(sent_message)
 
     def _setup_events(self):
         '''define bot events'''
@@ -40,12 +62,17 @@ class DiscordHandler():
         async def on_ready():
             print(f'OCKY system active as {self.bot.user}')
             # init response adder
-            await self.bot.add_cog(ResponseAdder(self.bot,self.ocky_bot,self.data_manager))
+            await self.bot.add_cog(ResponseAdder(self.bot,self.ocky_bot))
             synced = await self.bot.tree.sync()
             print(f"Synced {len(synced)} slash commands")
 
             # training loop & finish
             self.training_loop.start()
+            self.residency_loop.start()
+            if self.ocky_bot.guilds is not None or self.ocky_bot.training_manager.online:
+                self.online_training_loop.change_interval(minutes=self.config.get('online_training_minutes', 10))
+                self.online_training_loop.start()
+            await self._start_metrics()
             if self.channel_id: 
                 self.channel = self.bot.get_channel(self.channel_id)
                 if self.channel:
@@ -53,72 +80,141 @@ class DiscordHandler():
 
         @self.bot.event
         async def on_message(message: discord.Message):
+            ''' staged: channel filter -> scalar features -> classifier -> sentence embedding + choice.
+                each stage only runs for messages that survived the one before it.
+            '''
+            if message.author.bot: return
+            inference = self.ocky_bot.inference
+
+            # this guild's systems (guild mode: loaded on its first message, None if not served)
+            context = await self.ocky_bot.get_context(self._guild_id(message))
+            if context is None: return
+            response_system = context.response_system
+            
+            # process commands first
+            await self._check_commands(context, message)
+            
+            print(f'message got: {message.content}')
+            
+            # track message activity
+            context.data_manager.track_channel_activity(message)
+
+            # stage 1: channel filter. other channels only get their (cheap) scalar features recorded
+            if context.channel_id and (message.channel.id != context.channel_id):
+                response_system.should_respond(message, self.bot.user, skip='other_channel')
+                return
+
+            # stage 2+3: scalar features & classifier (low priority: dropped when overloaded)
+            try:
+                response_chance = await inference.run(
+                    response_system.should_respond, message, self.bot.user, low_priority=True
+                )
+            except Overloaded as e:
+                # only the classifier is dropped: the training point is recorded here, like stage 1
+                print(f"inference overloaded, skipped message ({e})")
+                response_system.should_respond(message, self.bot.user, skip='overloaded')
+                return
+            if response_chance <= response_system.threshold: return
+
+            # stage 4: embed (together with other messages arriving right now) and choose
             try:
-                if message.author.bot: return
-                
-                # process commands first
-                await self._check_commands(message)
-                
-                print(f'message got: {message.content}')
-                
-                # track message activity
-                self.data_manager.track_channel_activity(message)
-
-                # ask response system: should we respond?
-                response_chance = self.ocky_bot.response_system.should_respond(message, self.bot.user)
-
-                # check if we should only respond in specific channel
-                if self.channel_id and (message.channel.id != self.channel_id): return
-                
-                # decide to respond based on probability
-                if response_chance > 0.5:  # 50% threshold
-                    # ask choice system: what to respond with?
-                    response = self.ocky_bot.choice_system.get_response(message)
-                    if response: await self.send_response(message, response)
-            # always unload to end with
-            finally: self.ocky_bot.choice_system.sentence_model.unload()
+                embedding = await self.ocky_bot.batcher.encode(message.content)
+                response = await inference.run(context.choice_system.get_response, message, embedding)
+                if response: await self.send_response(context, message, response)
+            # always release to end with (unloads according to residency policy)
+            finally: await inference.run(self.ocky_bot.sentence_model.release)
 
         @self.bot.event
         async def on_reaction_add(reaction, user):
             if user.bot: return
+            context = await self.ocky_bot.get_context(self._guild_id(reaction.message))
+            if context is None: return
+
             # if emote is "forceful reaction emote" then respond
-            if reaction.emoji == self.config['forceful_react_emote']:
+            if reaction.emoji == context.config['forceful_react_emote']:
                 print("Respond Emote Received.")
+                requested_at = discord.utils.utcnow()  # the message itself may be hours old
                 message = reaction.message
-                response = self.ocky_bot.choice_system.get_response(message)
+                response = await self.ocky_bot.inference.run(context.choice_system.get_response, message)
                 if response: 
-                    await self.send_response(message, response)
-                self.ocky_bot.choice_system.sentence_model.unload()
+                    await self.send_response(context, message, response, requested_at)
+                await self.ocky_bot.inference.run(self.ocky_bot.sentence_model.release)
+                # and it's a label for the response classifier: this message wanted a response
+                await context.data_manager.process_feedback(reaction, user, is_add=True, bot_user=self.bot.user)
 
             # process feedback
-            if reaction.emoji in ["👍","👎","🟩","🟥"]:
-                value = await self.data_manager.process_feedback(reaction, user, is_add=True, bot_user=self.bot.user)
+            if str(reaction.emoji) in EMOJI_SCORES:
+                with metrics.timer('ocky_feedback_seconds'):
+                    value = await context.data_manager.process_feedback(reaction, user, is_add=True, bot_user=self.bot.user)
                 print(f"Feedbacd incorporated ({value})")
         
         @self.bot.event
         async def on_reaction_remove(reaction, user):
             if user.bot: return
-            await self.data_manager.process_feedback(reaction, user, is_add=False, bot_user=self.bot.user)
+            context = await self.ocky_bot.get_context(self._guild_id(reaction.message))
+            if context is None: return
+            with metrics.timer('ocky_feedback_seconds'):
+                await context.data_manager.process_feedback(reaction, user, is_add=False, bot_user=self.bot.user)
 
-        @tasks.loop(hours=1)  # try to train every hour by default
+        @tasks.loop(hours=1)  # try to train every hour by default (every loaded guild, one after the other)
         async def training_loop():
+            for context in self.ocky_bot.contexts():
+                try:
+                    await context.training_manager.training_loop(context)
+                except Exception as e:
+                    print(f"Training error: {e}")
+
+        @tasks.loop(minutes=10)  # small online updates of the response classifier in between
+        async def online_training_loop():
+            for context in self.ocky_bot.contexts():
+                try:
+                    await self.ocky_bot.inference.run(
+                        context.training_manager.online_update, context.response_system
+                    )
+                except Exception as e:
+                    print(f"Online training error: {e}")
+
+        @tasks.loop(seconds=60)  # metrics as JSON file (config metrics_dump)
+        async def metrics_dump_loop():
             try:
-                await self.ocky_bot.training_manager.training_loop(self.ocky_bot.response_system,self.ocky_bot.choice_system)
-            except Exception as e:
-                print(f"Training error: {e}")
+                metrics.dump_json(self.config['metrics_dump'])
+            except OSError as e:
+                print(f"Metrics dump error: {e}")
+
+        @tasks.loop(seconds=30)  # unload the sentence model (and idle guilds) when idle / low on RAM
+        async def residency_loop():
+            await self.ocky_bot.inference.run(self.ocky_bot.sentence_model.check_residency)
+            if self.ocky_bot.guilds is not None:
+                await self.ocky_bot.inference.run(self.ocky_bot.guilds.evict_idle, asyncio.get_running_loop())
 
         # make it callable too
         self.training_loop = training_loop
+        self.online_training_loop = online_training_loop
+        self.residency_loop = residency_loop
+        self.metrics_dump_loop = metrics_dump_loop
+
+    async def _start_metrics(self):
+        '''metrics endpoint (metrics_port, 0 for none) and/or JSON dump, with metrics on'''
+        if not metrics.enabled: return
+        port = self.config.get('metrics_port', 9108)
+        if port and self.metrics_server is None:
+            self.metrics_server = MetricsServer(metrics, self.config.get('metrics_host', '127.0.0.1'), port)
+            try: await self.metrics_server.start()
+            except OSError as e:
+                print(f"Can't start metrics endpoint: {e}")
+                self.metrics_server = None
+        if self.config.get('metrics_dump') and not self.metrics_dump_loop.is_running():
+            self.metrics_dump_loop.change_interval(seconds=self.config.get('metrics_dump_seconds', 60))
+            self.metrics_dump_loop.start()
+
+    def _guild_id(self, message):
+        return message.guild.id if getattr(message, 'guild', None) is not None else None
 
-    async def _check_commands(self, message):
+    async def _check_commands(self, context, message):
         content = message.content.lower()
 
         if "retrain" in content and "models" in content:
             print("Manual retraining...")
-            await self.ocky_bot.training_manager.training_loop(
-                self.ocky_bot.response_system,
-                self.ocky_bot.choice_system,
-                message
-            )
+            await context.training_manager.training_loop(context, message)
         elif "shutdown" in content and any(phrase in content for phrase in ['pls','thx','aub','thanks','please','thank']):
             await self.ocky_bot.shutdown()
\ No newline at end of file
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from collections.abc import Mapping
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.preprocessing import StandardScaler
+
+FORMAT_VERSION = 1
+
+# fitted attributes that fully describe each model, stored as plain arrays
+CLASSIFIERS = {
+    'LogisticRegression': (LogisticRegression, {}),
+    'SGDClassifier': (SGDClassifier, {'loss': 'log_loss'})
+}
+CLASSIFIER_ATTRS = ['coef_', 'intercept_', 'classes_', 'n_features_in_', 'n_iter_', 't_']
+SCALER_ATTRS = ['mean_', 'var_', 'scale_', 'n_samples_seen_', 'n_features_in_']
+
+# files per part of a checkpoint
+PART_FILES = {
+    'classifier': ['classifier.npz'],
+    'scaler': ['scaler.npz'],
+    'embeddings': ['embeddings.npy', 'embedding_ids.json'],
+    'history': ['response_features.npy', 'response_labels.npy']
+}
+
+def _model_arrays(model, attrs):
+    return {attr: np.asarray(getattr(model, attr)) for attr in attrs if getattr(model, attr, None) is not None}
+
+def _fsync(path):
+    ''' flush a file (or directory entry list) to disk. on windows fsync needs a writable
+        handle, and directories can't be opened at all
+    '''
+    if os.path.isdir(path):
+        if os.name == 'nt': return
+        fd = os.open(path, os.O_RDONLY)
+    else: fd = os.open(path, os.O_RDWR)
+    try: os.fsync(fd)
+    finally: os.close(fd)
+
+def _restore(model, arrays):
+    for attr in arrays.files:
+        value = arrays[attr]
+        # 0-d arrays stay numpy scalars: sklearn reads .shape off some of them (n_samples_seen_)
+        setattr(model, attr, value[()] if value.ndim == 0 else value)
+    return model
+
+def _check_trainable(path, model):
+    '''restore a just written model and train it one dummy step, so a checkpoint never holds a model that can't keep learning'''
+    with np.load(path) as arrays:
+        if 'n_features_in_' not in arrays.files: return  # never fitted
+        restored = _restore(type(model)(**model.get_params()), arrays)
+    X = np.zeros((2, int(restored.n_features_in_)))
+    try:
+        if isinstance(restored, StandardScaler): restored.partial_fit(X)
+        elif hasattr(restored, 'partial_fit'): restored.partial_fit(X, restored.classes_[:2], classes=restored.classes_)
+        else: restored.fit(X, restored.classes_[:2])
+    except Exception as e:
+        raise ValueError(f"saved {type(model).__name__} can't be trained after loading: {e}")
+
+class SavedEmbeddings(Mapping):
+    '''response_id -> embedding, read straight from a (memory-mapped) checkpoint matrix'''
+    def __init__(self, ids, matrix):
+        self.ids = ids
+        self.matrix = matrix
+        self._rows = {response_id: row for row, response_id in enumerate(ids)}
+
+    def __getitem__(self, response_id):
+        return self.matrix[self._rows[response_id]]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+class Checkpoint:
+    ''' one saved checkpoint directory. parts are only read when asked for,
+        embeddings memory-mapped.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != FORMAT_VERSION:
+            raise ValueError(f"unsupported checkpoint format {self.manifest.get('format')}")
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    @property
+    def state(self):
+        return self.manifest.get('state')
+
+    def has(self, part):
+        return part in self.manifest['parts']
+
+    def classifier(self):
+        cls, kwargs = CLASSIFIERS[self.manifest['classifier_type']]
+        with np.load(os.path.join(self.path, 'classifier.npz')) as arrays:
+            return _restore(cls(**kwargs), arrays)
+
+    def scaler(self):
+        with np.load(os.path.join(self.path, 'scaler.npz')) as arrays:
+            return _restore(StandardScaler(), arrays)
+
+    def embeddings(self):
+        with open(os.path.join(self.path, 'embedding_ids.json'), 'r', encoding='utf-8') as f:
+            ids = [tuple(response_id) for response_id in json.load(f)]
+        return SavedEmbeddings(ids, np.load(os.path.join(self.path, 'embeddings.npy'), mmap_mode='r'))
+
+    def history(self):
+        '''the respond classifier's batch training history as (features, labels), memory-mapped'''
+        return tuple(np.load(os.path.join(self.path, filename), mmap_mode='r') for filename in PART_FILES['history'])
+
+class CheckpointStore:
+    ''' versioned model checkpoints: <root>/<version>/ holding the classifier and scaler
+        as plain arrays, the response embeddings as an .npy matrix plus id table, the batch
+        training history (the rows the state's learned_until cursor counts) and a
+        manifest. a checkpoint is written to a temp dir and renamed into place, then
+        LATEST is (atomically) pointed at it, so a crash mid-save never corrupts the
+        current one. every file and the directories are fsynced before LATEST moves.
+        the last `keep` checkpoints stay around for rollback.
+        parts that aren't given to save() are carried over from the latest checkpoint.
+    '''
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = keep
+        os.makedirs(root, exist_ok=True)
+
+    def versions(self):
+        '''saved versions, oldest first'''
+        return sorted(int(name) for name in os.listdir(self.root) if name.isdigit())
+
+    def latest(self):
+        try:
+            with open(os.path.join(self.root, 'LATEST'), 'r') as f:
+                return Checkpoint(os.path.join(self.root, f.read().strip()))
+        except (OSError, ValueError) as e:
+            if os.path.exists(os.path.join(self.root, 'LATEST')): print(f"Can't read latest checkpoint: {e}")
+            return None
+
+    def load(self, version):
+        return Checkpoint(os.path.join(self.root, f'{version:06d}'))
+
+    def save(self, classifier=None, scaler=None, embeddings=None, history=None, state=None, base=None):
+        ''' write a new checkpoint, returns its version. base: the version the given parts were
+            computed from (a training snapshot). if checkpoints were saved since, responses they
+            added are merged into the embeddings instead of dropped
+        '''
+        previous = self.latest()
+        if embeddings is not None and base is not None and previous is not None and previous.version != base:
+            embeddings = self._rebase_embeddings(embeddings, previous)
+        tmp = os.path.join(self.root, f'.tmp-{os.getpid()}-{time.time_ns()}')
+        os.makedirs(tmp)
+        try:
+            manifest = {'format': FORMAT_VERSION, 'created': time.time(), 'parts': [], 'state': state}
+            if state is None and previous is not None: manifest['state'] = previous.state
+
+            if classifier is not None:
+                np.savez(os.path.join(tmp, 'classifier.npz'), **_model_arrays(classifier, CLASSIFIER_ATTRS))
+                _check_trainable(os.path.join(tmp, 'classifier.npz'), classifier)
+                manifest['classifier_type'] = type(classifier).__name__
+            if scaler is not None:
+                np.savez(os.path.join(tmp, 'scaler.npz'), **_model_arrays(scaler, SCALER_ATTRS))
+                _check_trainable(os.path.join(tmp, 'scaler.npz'), scaler)
+            if embeddings is not None:
+                np.save(os.path.join(tmp, 'embeddings.npy'), np.asarray(embeddings.matrix, dtype=np.float32))
+                with open(os.path.join(tmp, 'embedding_ids.json'), 'w', encoding='utf-8') as f:
+                    json.dump([list(response_id) for response_id in embeddings.ids], f, ensure_ascii=False)
+            if history is not None:
+                for matrix, filename in zip(history, PART_FILES['history']): np.save(os.path.join(tmp, filename), matrix)
+
+            for part, value in (('classifier', classifier), ('scaler', scaler), ('embeddings', embeddings), ('history', history)):
+                if value is not None: manifest['parts'].append(part)
+                elif previous is not None and previous.has(part):
+                    self._carry_over(previous, tmp, part)
+                    manifest['parts'].append(part)
+                    if part == 'classifier': manifest['classifier_type'] = previous.manifest['classifier_type']
+
+            # rename into place under the next free version
+            while True:
+                versions = self.versions()
+                version = versions[-1] + 1 if versions else 1
+                manifest['version'] = version
+                with open(os.path.join(tmp, 'manifest.json'), 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f)
+                for filename in os.listdir(tmp): _fsync(os.path.join(tmp, filename))
+                _fsync(tmp)
+                try:
+                    os.rename(tmp, os.path.join(self.root, f'{version:06d}'))
+                    _fsync(self.root)
+                    break
+                except OSError:
+                    if not os.path.exists(os.path.join(self.root, f'{version:06d}')): raise
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        self._set_latest(version)
+        self._prune()
+        return version
+
+    def _rebase_embeddings(self, embeddings, previous):
+        '''embeddings plus the responses only previous has (added while they were being computed)'''
+        if not previous.has('embeddings'): return embeddings
+        saved = previous.embeddings()
+        ids = list(embeddings.ids)
+        known = set(ids)
+        added = [response_id for response_id in saved.ids if response_id not in known]
+        if not added: return embeddings
+        print(f"Checkpoint {previous.version} was saved in the meantime, keeping its {len(added)} new response(s)")
+        matrix = np.concatenate([np.asarray(embeddings.matrix, dtype=np.float32), np.stack([saved[rid] for rid in added]).astype(np.float32)])
+        return SavedEmbeddings(ids + added, matrix)
+
+    def _carry_over(self, previous, tmp, part):
+        for filename in PART_FILES[part]:
+            source = os.path.join(previous.path, filename)
+            try: os.link(source, os.path.join(tmp, filename))
+            except OSError: shutil.copy2(source, os.path.join(tmp, filename))
+
+    def _set_latest(self, version):
+        tmp = os.path.join(self.root, f'LATEST.tmp-{os.getpid()}')
+        with open(tmp, 'w') as f:
+            f.write(f'{version:06d}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.root, 'LATEST'))
+        _fsync(self.root)
+
+    def rollback(self):
+        '''point LATEST back at the checkpoint before it, returns that version (or None)'''
+        current = self.latest()
+        older = [v for v in self.versions() if current is None or v < current.version]
+        if not older: return None
+        self._set_latest(older[-1])
+        return older[-1]
+
+    def _prune(self):
+        current = self.latest()
+        for version in self.versions()[:-self.keep]:
+            if current is not None and version == current.version: continue
+            shutil.rmtree(os.path.join(self.root, f'{version:06d}'), ignore_errors=True)
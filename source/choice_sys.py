@@ -1,68 +1,133 @@
 import time
 import hashlib
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from collections import defaultdict
+from embed_index import make_index, EmbeddingIndex
+from metrics import metrics
 
 class ChoiceSystem():
-    def __init__(self, config, data_manager, sentence_model, responses):
+    def __init__(self, config, data_manager, sentence_model, responses, previous=None):
         self.config = config
         self.data_manager = data_manager
         self.sentence_model = sentence_model
         self.responses = responses
         
         self.response_dict = {}  # response_id -> response
-        self.response_embeddings = {}  # response_id -> target embedding
-        
-        self._load_embeddings()
+        self.response_embeddings = make_index(config)  # response_id -> target embedding (matrix backed)
+        self.baseline_embeddings = None  # response_id -> embedding of the response text itself, for drift stats
 
-    def get_response(self, message):
-        ''' Choice System: selects best response using embedding similarity matching'''
-        msg_embed = self.sentence_model.encode(message.content)
-        best_score = -1
-        best_response = None
+        # hot reload: take over the (trained) embeddings of the old instance instead of the saved ones
+        if previous is not None:
+            self.response_embeddings = previous.response_embeddings
+            self.baseline_embeddings = previous.baseline_embeddings
         
-        # find most similar response embedding
-        for response_id, target_embed in self.response_embeddings.items():
-            similarity = np.dot(msg_embed, target_embed) / (
-                np.linalg.norm(msg_embed) * np.linalg.norm(target_embed)
+        self._load_embeddings(previous)
+
+    def get_response(self, message, embedding=None):
+        ''' Choice System: selects best response using embedding similarity matching.
+            the top-k candidates (config choice_top_k) are returned along with the best one.
+            embedding: of the message, if it's already encoded (micro-batched in on_message)
+        '''
+        with metrics.timer('ocky_choose_seconds'):
+            msg_embed = self.sentence_model.encode(message.content) if embedding is None else embedding
+
+            # score all responses at once, with randomness
+            candidates = self.response_embeddings.search(
+                msg_embed, self.config.get('choice_top_k', 5), self.config['randomness']
             )
-            # randomness
-            noise = np.random.normal(0, self.config['randomness'])
-            similarity += noise
-            # check if best
-            if similarity > best_score:
-                best_score = similarity
-                best_response = response_id
- 
+        if not candidates: return None
+
         # get the actual response text
-        if best_response:
-            print(f'CHOICE: {best_response}, score {best_score}')
-            response_text = self.response_dict[best_response]
-            return {'id': best_response, 'text': response_text, 'score': best_score}
-        return None
+        best_response, best_score = candidates[0]
+        print(f'CHOICE: {best_response}, score {best_score}')
+        return {
+            'id': best_response,
+            'text': self.response_dict[best_response],
+            'score': best_score,
+            'embedding': msg_embed,  # reused for the training record
+            'candidates': [{'id': rid, 'text': self.response_dict[rid], 'score': score} for rid, score in candidates]
+        }
 
-    def _load_embeddings(self):
+    def _load_embeddings(self, previous=None):
         ''' create initial embeddings for each response, using example_input if available.
-            these are overridden then by datamanager loading the models.
+            saved embeddings from the datamanager (or the previous instance's, on reload)
+            take priority, so only responses that are new (or missing from the saved file)
+            get encoded, in one batch.
         '''
-        # create initial embeddings
+        start = time.perf_counter()
+        saved_embeddings = self.response_embeddings if previous is not None else self.data_manager.load_response_embeddings()
+
+        # find which responses need a fresh embedding, and from what text
+        to_encode = {}  # response_id -> text to embed
         for category, category_data in self.responses.items():
             # parse per catgory
             responses_list = category_data.get('responses', [])
             example_input = category_data.get('example_input')
-            
+
             for response in responses_list:
                 response_hash = hashlib.md5(response.encode('utf-8')).hexdigest()[:10]
                 response_id = (category, response_hash)
-                
-                # Use example_input for embedding if available, otherwise fall back to response text
-                if example_input != 'None': self.response_embeddings[response_id] = self.sentence_model.encode(example_input)
-                else: self.response_embeddings[response_id] = self.sentence_model.encode(response)
-                    
-                # add a smidgeon of randomness
                 self.response_dict[response_id] = response
 
-        # override embeddings with saved embeds. Filter out responses no longer in the response file
-        saved_embeddings = self.data_manager.load_response_embeddings()
-        filtered_saved = {k: v for k, v in saved_embeddings.items() if k in self.response_dict}
-        self.response_embeddings.update(filtered_saved)
\ No newline at end of file
+                # saved embeddings override. Responses no longer in the response file are left out
+                if response_id in saved_embeddings:
+                    if saved_embeddings is not self.response_embeddings:
+                        self.response_embeddings[response_id] = saved_embeddings[response_id]
+                # Use example_input for embedding if available, otherwise fall back to response text
+                elif example_input and example_input != 'None': to_encode[response_id] = example_input
+                else: to_encode[response_id] = response
+
+        # handed over embeddings: drop responses that are gone from the response file
+        for response_id in [rid for rid in self.response_embeddings if rid not in self.response_dict]:
+            del self.response_embeddings[response_id]
+
+        # encode every distinct text once, batched
+        texts = list(dict.fromkeys(to_encode.values()))
+        if texts:
+            encoded = self.sentence_model.encode(texts, persist=True, batch_size=self.config.get('encode_batch_size', 64))
+            encoded = dict(zip(texts, encoded))
+            for response_id, text in to_encode.items():
+                self.response_embeddings[response_id] = encoded[text]
+
+        print(f"Loaded {len(self.response_dict)} responses ({len(to_encode)} new, {len(texts)} texts encoded) in {time.perf_counter() - start:.2f}s")
+
+    def swap_embeddings(self, ids, matrix):
+        '''take over trained embeddings. responses added or removed since the
+           training snapshot keep their current state'''
+        known = [i for i, rid in enumerate(ids) if rid in self.response_embeddings]
+        if not known: return
+        rows = [self.response_embeddings.row(ids[i]) for i in known]
+        self.response_embeddings.set_rows(rows, matrix[known])
+
+    def ensure_baselines(self):
+        ''' baseline (original text) embeddings for every response, for drift stats.
+            kept on disk and only encoded for responses that don't have one yet; the
+            response id contains the text hash, so a changed text gets a new baseline.
+        '''
+        if self.baseline_embeddings is None:
+            saved = self.data_manager.load_baseline_embeddings()
+            self.baseline_embeddings = EmbeddingIndex()
+            for response_id, embedding in saved.items():
+                if response_id in self.response_dict: self.baseline_embeddings[response_id] = embedding
+
+        missing = [rid for rid in self.response_dict if rid not in self.baseline_embeddings]
+        if missing:
+            texts = [self.response_dict[rid] for rid in missing]
+            encoded = self.sentence_model.encode(texts, persist=True, batch_size=self.config.get('encode_batch_size', 64))
+            for response_id, embedding in zip(missing, encoded): self.baseline_embeddings[response_id] = embedding
+            self.data_manager.save_model(dict(self.baseline_embeddings), 'baseline_embeddings.pkl')
+        return self.baseline_embeddings
+
+    def embedding_drift(self):
+        '''cosine distance of every response embedding to its baseline: (average, {category: average})'''
+        baselines = self.ensure_baselines()
+        ids = [rid for rid in self.response_embeddings.ids if rid in baselines]
+        if not ids: return None, {}
+
+        current = self.response_embeddings.normalized[[self.response_embeddings.row(rid) for rid in ids]]
+        original = baselines.normalized[[baselines.row(rid) for rid in ids]]
+        drift = 1 - np.einsum('ij,ij->i', current, original)
+
+        per_category = defaultdict(list)
+        for i, (category, _) in enumerate(ids): per_category[category].append(i)
+        return float(drift.mean()), {category: float(drift[rows].mean()) for category, rows in per_category.items()}
@@ -1,17 +1,109 @@
+import os
 import pickle
 import time
+import asyncio
 import json
-from collections import defaultdict
-from sklearn.linear_model import LogisticRegression
+import numpy as np
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.preprocessing import StandardScaler
+from store import TrainingStore, ColumnBuffer
+from feedback_log import FeedbackLog
+from checkpoint import CheckpointStore
+from activity import ChannelActivity
+from feedback import FeedbackAggregator, EMOJI_SCORES
+from response_sys import feature_count, migrate_features
+from metrics import metrics
 
 class DataManager():
     '''Manages the training data and model/embed loading.'''
-    def __init__(self, config):
+    def __init__(self, config, previous=None):
         self.config = config
-        self.training_data = []  # training data
+        self.models_dir = config.get('models_dir', 'source/models')
+        self.store = TrainingStore(config.get('max_training_records', 50000))  # training data
         self.prev_response = {}  # channel_id -> timestamp of last bot response
-        self.msg_activity = defaultdict(list)  # channel_id -> list of message timestamps
+        self.activity = ChannelActivity()  # channel_id -> sliding window message counts
+        self.feedback = FeedbackAggregator()  # votes on bot messages, flushed into the store
+        self.feedback_debounce = config.get('feedback_debounce', 2.0)  # seconds
+        self._flush_timer = None
+        os.makedirs(self.models_dir, exist_ok=True)
+        self.checkpoints = CheckpointStore(os.path.join(self.models_dir, 'checkpoints'), config.get('checkpoint_keep', 3))
+
+        # durable log of the training data, replayed into the store on startup
+        self.log = None
+        self.closed = False
+        self._successor = None  # after a reload: the DataManager that took over
+        if previous is not None:
+            # hot reload: take over the in-memory data and the open log, nothing to replay.
+            # the old one passes late writes on (a pending vote flush, a handler holding it)
+            self.feedback = previous.feedback
+            self.store = previous.store
+            self.prev_response = previous.prev_response
+            self.activity = previous.activity
+            self.log, previous.log = previous.log, None
+            previous._successor = self
+        elif config.get('feedback_log', 1) == 1:
+            self.log = FeedbackLog(os.path.join(self.models_dir, 'feedback_log.db'))
+            self._replay_log()
+            self.log.start()
+
+    def _replay_log(self):
+        '''rebuild the training store from the feedback log'''
+        replayed = 0
+        for kind, key, payload in self.log.replay():
+            if kind == 'respond_request':
+                # logged with the other feature set: migrate (see ResponseSystem._check_feature_count)
+                payload['features'] = migrate_features(payload['features'], feature_count(self.config))
+                self.store.add_respond_request(payload)
+            elif kind == 'bot_response': self.store.add_bot_response(payload)
+            elif kind == 'respond_feedback': self._apply_respond_feedback(key)
+            elif kind == 'response_votes':
+                self.feedback.restore(key, payload)
+                self._apply_response_feedback(key, self.feedback.score(key))
+            elif kind == 'response_feedback': self._apply_response_feedback(key, payload)  # older logs: a score
+            replayed += 1
+        if replayed: print(f"Replayed {replayed} feedback log events")
+
+    def _log(self, kind, key, payload=None):
+        if self._successor is not None: return self._successor._log(kind, key, payload)
+        if self.closed: raise RuntimeError(f"data manager of {self.models_dir} is closed, {kind} event not recorded")
+        if self.log is not None: self.log.append(kind, key, payload)
+
+    def compact_log(self):
+        '''shrink the feedback log down to what the store still holds'''
+        if self._successor is not None: return self._successor.compact_log()
+        if self.log is None: return
+        # mark first: whatever is logged after it survives compaction. only the votes are copied
+        # here (the loop changes them), the store (thread safe) is exported on the log's writer
+        # thread. a record logged after the mark but already in that export is replayed twice,
+        # which changes nothing
+        self.flush_feedback()
+        mark = self.log.mark()
+        self.feedback.prune(lambda message_id: message_id in self.store.bot_responses)
+        votes = [('response_votes', message_id, self.feedback.export(message_id)) for message_id in list(self.feedback.votes)]
+        store = self.store
+
+        def snapshot():
+            events = [('respond_request', d['message_id'], d) for d in store.respond_requests.export()]
+            events += [('bot_response', d['bot_message_id'], d) for d in store.bot_responses.export()]
+            return events + votes
+
+        self.log.compact(snapshot, mark)
+
+    def close(self):
+        '''flush and close the log. writes after this raise (e.g. from a handler holding an evicted guild)'''
+        if self._successor is not None: return self._successor.close()
+        if self.closed: return
+        self.flush_feedback()
+        if self.log is not None: self.log.close()
+        self.closed = True
+
+    def _apply_respond_feedback(self, message_id):
+        if message_id in self.store.respond_requests:
+            self.store.respond_requests.update(message_id, should_respond=1)
+
+    def _apply_response_feedback(self, bot_message_id, score):
+        if bot_message_id in self.store.bot_responses:
+            self.store.bot_responses.update(bot_message_id, feedback_score=score)
 
     async def process_feedback(self, reaction, user, is_add, bot_user):
         '''Process user feedback reactions adding it to training data'''
@@ -19,72 +111,69 @@ class DataManager():
         
         # case 1: reaction on user message: response emoji
         if (message.author != bot_user) and (reaction.emoji == "🗣️") and is_add:
-            for data in self.training_data:
-                if data['type'] != 'respond_request': continue
-                if (data.get('message_id') == message.id):
-                    data['should_respond'] = 1
-                    break
+            if message.id in self.store.respond_requests:
+                metrics.inc('ocky_feedback_total', emoji=str(reaction.emoji), action='add')
+                self._apply_respond_feedback(message.id)
+                self._log('respond_feedback', message.id)
             return
 
-        # case 2: reaction on a bot message: feedback 
-        feedback_value = self._get_feedback_value(reaction.emoji)
-        if feedback_value is None: return
+        # case 2: reaction on a bot message: a vote. bursts are flushed into the store together
+        if self._get_feedback_value(reaction.emoji) is None: return
+        metrics.inc('ocky_feedback_total', emoji=str(reaction.emoji), action='add' if is_add else 'remove')
         
-        for data in self.training_data:
-            if (data['type'] == 'bot_response' and data['bot_message_id'] == message.id):
-                if is_add:
-                    # weirdass averaging system
-                    score = 0.5*(data['feedback_score'] + feedback_value)
-                else:
-                    # this undoes it but only once ^_^ after multiple scores this breaks. But does something
-                    # in the right direction. TODO: make a decent system.
-                    score = 2 * data['feedback_score'] - feedback_value
-                data['feedback_score'] = score
-                return score 
+        if message.id not in self.store.bot_responses: return
+        if self.feedback.vote(message.id, user.id, reaction.emoji, is_add) and self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self.feedback_debounce, self.flush_feedback)
+        return self.feedback.score(message.id)
+
+    def flush_feedback(self):
+        '''write the scores of messages whose votes changed to the store (and log their votes)'''
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        scores = self.feedback.flush()
+        for message_id, score in scores.items():
+            self._apply_response_feedback(message_id, score)
+            self._log('response_votes', message_id, self.feedback.export(message_id))
+        if scores: metrics.inc('ocky_feedback_flushed_total', len(scores))
 
     def _get_feedback_value(self, emoji):
         '''Convert emoji reactions to feedback scores'''
-        emoji_scores = {"👍": 1.0,"👎": -1.0,"🟩": 1.5,"🟥": -1.5}
-        score = emoji_scores.get(str(emoji), None)
-        return score
+        return EMOJI_SCORES.get(str(emoji), None)
 
-    def record_bot_response(self, original_message, bot_message, response_id, sentence_model):
-        '''Record a bot response for learning'''
-        self.training_data.append({
+    def record_bot_response(self, original_message, bot_message, response_id, embedding):
+        '''Record a bot response for learning. embedding: of the original message (the choice system's)'''
+        data = {
             'type': 'bot_response',
             'original_message': original_message.content,
-            'original_embedding': sentence_model.encode(original_message.content),
+            'original_embedding': embedding,
             'response_id': response_id,
             'bot_message_id': bot_message.id,
             'channel_id': bot_message.channel.id,
             'timestamp': time.time(),
             'feedback_score': 1
-        })
+        }
+        self.store.add_bot_response(data)
+        self._log('bot_response', data['bot_message_id'], data)
 
     def record_user_message(self, message, features):
         '''record this message as a training point for ocky responses. called in ResponseManager'''
-        self.training_data.append({
+        data = {
             'type': 'respond_request',
             'message': message.content,
             'message_id': message.id,
             'features': features['basic_features'],
             'should_respond': 0,  # Will be set to 1 if user reacts with 🗣️
             'timestamp': time.time()
-        })
+        }
+        self.store.add_respond_request(data)
+        self._log('respond_request', data['message_id'], data)
 
     def track_channel_activity(self, message):
         ''' track message activity for feature extraction during response training.
             also add onto the training data
         '''
-        channel_id = message.channel.id
-        current_time = time.time()
-
-        # add current message
-        self.msg_activity[channel_id].append(current_time)
-        
-        # keep only messages from last hour
-        hour_ago = current_time - 3600
-        self.msg_activity[channel_id] = [t for t in self.msg_activity[channel_id] if t > hour_ago]
+        self.activity.track(message.channel.id)
 
     def load_model(self, path, default, name):
         '''loads a model if it exists'''
@@ -98,33 +187,89 @@ class DataManager():
             return default
 
     def load_response_classifier(self):
-        return self.load_model('response_classifier.pkl', LogisticRegression(), 'response classifier')
+        '''LogisticRegression, or a streaming logistic model (SGD) for online training'''
+        checkpoint = self.checkpoints.latest()
+        if checkpoint is not None and checkpoint.has('classifier'):
+            classifier = checkpoint.classifier()
+            print(f'Loaded response classifier (checkpoint {checkpoint.version})')
+        else: classifier = self.load_model(os.path.join(self.models_dir, 'response_classifier.pkl'), None, 'response classifier')
+
+        if self.config.get('response_training', 'batch') == 'online':
+            if not hasattr(classifier, 'partial_fit'):
+                print("Starting online response classifier fresh.")
+                classifier = SGDClassifier(loss='log_loss')
+            return classifier
+        return classifier if classifier is not None else LogisticRegression()
 
     def load_feature_scaler(self):
-        return self.load_model('source/models/feature_scaler.pkl', StandardScaler(), 'feature scaler')
+        checkpoint = self.checkpoints.latest()
+        if checkpoint is not None and checkpoint.has('scaler'):
+            print(f'Loaded feature scaler (checkpoint {checkpoint.version})')
+            return checkpoint.scaler()
+        return self.load_model(os.path.join(self.models_dir, 'feature_scaler.pkl'), StandardScaler(), 'feature scaler')
 
     def load_response_embeddings(self):
-        return self.load_model('source/models/response_embeddings.pkl', {}, 'response embeddings')
+        '''saved response_id -> embedding mapping (memory-mapped from the checkpoint)'''
+        checkpoint = self.checkpoints.latest()
+        if checkpoint is not None and checkpoint.has('embeddings'):
+            print(f'Loaded response embeddings (checkpoint {checkpoint.version})')
+            return checkpoint.embeddings()
+        return self.load_model(os.path.join(self.models_dir, 'response_embeddings.pkl'), {}, 'response embeddings')
+
+    def load_training_state(self):
+        checkpoint = self.checkpoints.latest()
+        if checkpoint is not None and checkpoint.state is not None: return checkpoint.state
+        return self.load_model(os.path.join(self.models_dir, 'training_state.pkl'), {'learned_until': 0.0}, 'training state')
+
+    def load_baseline_embeddings(self):
+        return self.load_model(os.path.join(self.models_dir, 'baseline_embeddings.pkl'), {}, 'baseline embeddings')
 
     def load_response_training_data(self):
-        return self.load_model('source/models/response_data.pkl', [], 'response training data')
-
-    def save_models(self, response_classifier, feature_scaler, response_embeddings, response_training_data):
-        '''Save trained models to disk'''
-        models = [
-            (response_classifier, 'response_classifier.pkl'),
-            (feature_scaler, 'feature_scaler.pkl'),
-            (response_embeddings, 'response_embeddings.pkl'),
-            (response_training_data, 'response_data.pkl')
-        ]
-        
-        for model_object, filename in models:
-            self.save_model(model_object, filename)
+        '''past respond classifier data as (features, labels) matrices, memory-mapped'''
+        checkpoint = self.checkpoints.latest()
+        if checkpoint is not None and checkpoint.has('history'):
+            print(f'Loaded response training data (checkpoint {checkpoint.version})')
+            return checkpoint.history()
+
+        # older formats: next to the models, or a pickled list of dicts
+        features_path = os.path.join(self.models_dir, 'response_features.npy')
+        labels_path = os.path.join(self.models_dir, 'response_labels.npy')
+        if os.path.exists(features_path) and os.path.exists(labels_path):
+            features = ColumnBuffer.load(features_path).view()
+            labels = ColumnBuffer.load(labels_path).view()
+            print('Loaded response training data')
+            return features, labels
+
+        legacy = self.load_model(os.path.join(self.models_dir, 'response_data.pkl'), [], 'response training data')
+        if not legacy: return np.zeros((0, 0)), np.zeros(0, dtype=np.int8)
+        return np.array([d['features'] for d in legacy]), np.array([d['should_respond'] for d in legacy], dtype=np.int8)
+
+    def save_models(self, response_classifier, feature_scaler, response_embeddings, response_training_data, state=None, base=None):
+        ''' Save trained models to disk as one checkpoint. response_training_data is a (features, labels) pair,
+            saved in the checkpoint with the state so learned_until always matches it.
+            base: checkpoint version the training snapshot was taken at
+        '''
+        self.save_checkpoint(
+            classifier=response_classifier, scaler=feature_scaler, embeddings=response_embeddings,
+            history=response_training_data, state=state, base=base
+        )
+
+    def save_checkpoint(self, **parts):
+        '''new checkpoint with the given parts (classifier, scaler, embeddings, history, state, base), the rest carried over'''
+        try:
+            version = self.checkpoints.save(**parts)
+            print(f"Saved checkpoint {version} ({', '.join(part for part in parts if part != 'base')})")
+            return True
+        except Exception as e:
+            print(f"Error saving checkpoint: {e}")
+            return False
 
     def save_model(self, model_object, filename):
         try:
-            with open(f'source/models/{filename}', 'wb') as f:
+            path = os.path.join(self.models_dir, filename)
+            with open(path + '.tmp', 'wb') as f:
                 pickle.dump(model_object, f)
+            os.replace(path + '.tmp', path)
             print(f"Saved {filename}")
             return True
         except Exception as e:
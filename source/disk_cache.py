@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+FORMAT_VERSION = 1
+
+def text_key(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+class DiskEmbeddingCache:
+    ''' embeddings of texts that don't change (response texts, example inputs) kept on
+        disk across restarts and reloads: <path>/embeddings.npy, a fixed size memory-mapped
+        matrix of max_size rows, and <path>/index.json with text hash -> [row, crc32],
+        least recently used first. path should be per model (and backend): a different
+        model gives different embeddings.
+        a row's crc32 is checked on every read, a bad row is dropped and encoded again.
+        rows are written (and flushed) before the index that points at them, which is
+        replaced atomically, so a crash at worst loses the newest entries.
+        hits only reorder the LRU in memory: the index is rewritten when entries change
+        (put, eviction, a dropped row), and takes the order along then.
+        one process per cache dir (shards: use the shared encoder worker).
+    '''
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self.dim = None
+        self._matrix = None
+        self._entries = OrderedDict()  # text hash -> [row, crc32], least recently used first
+        self._free = []
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+        os.makedirs(path, exist_ok=True)
+        self._open()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    @property
+    def _matrix_path(self):
+        return os.path.join(self.path, 'embeddings.npy')
+
+    def _open(self):
+        '''load index + matrix, starting empty if they're missing or don't match'''
+        if not os.path.exists(self._index_path): return
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('format') != FORMAT_VERSION or index['capacity'] != self.max_size:
+                raise ValueError(f"format {index.get('format')}, capacity {index.get('capacity')}")
+            matrix = np.load(self._matrix_path, mmap_mode='r+')
+            if matrix.shape != (self.max_size, index['dim']) or matrix.dtype != np.float32:
+                raise ValueError(f"matrix {matrix.shape} {matrix.dtype}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Embedding disk cache in {self.path} unusable ({e}), starting it fresh.")
+            return
+
+        self.dim = index['dim']
+        self._matrix = matrix
+        self._entries = OrderedDict((key, entry) for key, entry in index['entries'] if 0 <= entry[0] < self.max_size)
+        used = {row for row, _ in self._entries.values()}
+        self._free = [row for row in range(self.max_size - 1, -1, -1) if row not in used]
+
+    def _create(self, dim):
+        self.dim = dim
+        self._matrix = np.lib.format.open_memmap(self._matrix_path, mode='w+', dtype=np.float32, shape=(self.max_size, dim))
+        self._entries.clear()
+        self._free = list(range(self.max_size - 1, -1, -1))
+
+    def get(self, text):
+        '''embedding of text (a copy) or None'''
+        with self._lock:
+            key = text_key(text)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            row, crc = entry
+            embedding = np.array(self._matrix[row])
+            if zlib.crc32(embedding.tobytes()) != crc:
+                # integrity check failed: forget it, it'll be encoded again
+                self.corrupt += 1
+                self.misses += 1
+                del self._entries[key]
+                self._free.append(row)
+                self._dirty = True
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, text, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            if self._matrix is None or embedding.shape[0] != self.dim: self._create(embedding.shape[0])
+            key = text_key(text)
+            if key in self._entries: row = self._entries.pop(key)[0]
+            elif self._free: row = self._free.pop()
+            else: row = self._entries.popitem(last=False)[1][0]  # evict least recently used
+            self._matrix[row] = embedding
+            self._entries[key] = [row, zlib.crc32(embedding.tobytes())]
+            self._dirty = True
+
+    def flush(self):
+        '''write rows to disk, then the index that points at them'''
+        with self._lock:
+            if not self._dirty or self._matrix is None: return
+            self._matrix.flush()
+            index = {
+                'format': FORMAT_VERSION, 'dim': self.dim, 'capacity': self.max_size, 'written': time.time(),
+                'entries': [[key, entry] for key, entry in self._entries.items()]
+            }
+            tmp = f'{self._index_path}.tmp-{os.getpid()}'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._index_path)
+            self._dirty = False
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'corrupt': self.corrupt,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,258 @@
+import numpy as np
+from collections.abc import MutableMapping
+
+class EmbeddingIndex(MutableMapping):
+    ''' response_id -> embedding mapping kept as one contiguous float32 matrix
+        (plus a pre-normalized copy) so similarity search is a single matrix-vector
+        product. behaves like the old dict, so training/adding responses still just
+        assign to it and the matrix updates in place.
+    '''
+    def __init__(self, dim=None, capacity=64):
+        self.dim = dim
+        self.ids = []   # row -> response_id
+        self._rows = {} # response_id -> row
+        self._raw = None
+        self._normed = None
+        self._capacity = capacity
+        if dim is not None: self._allocate(dim, capacity)
+
+    def _allocate(self, dim, capacity):
+        self.dim = dim
+        raw = np.zeros((capacity, dim), dtype=np.float32)
+        normed = np.zeros((capacity, dim), dtype=np.float32)
+        if self._raw is not None:
+            n = len(self.ids)
+            raw[:n] = self._raw[:n]
+            normed[:n] = self._normed[:n]
+        self._raw, self._normed, self._capacity = raw, normed, capacity
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    # mapping interface
+    def __getitem__(self, response_id):
+        return self._raw[self._rows[response_id]].copy()
+
+    def __setitem__(self, response_id, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self._raw is None: self._allocate(embedding.shape[-1], self._capacity)
+        row = self._rows.get(response_id)
+        if row is None:
+            row = len(self.ids)
+            if row == self._capacity: self._allocate(self.dim, self._capacity * 2)
+            self.ids.append(response_id)
+            self._rows[response_id] = row
+        self._raw[row] = embedding
+        self._normed[row] = self._normalize(embedding)
+
+    def __delitem__(self, response_id):
+        # swap last row into the freed slot to stay contiguous
+        row = self._rows.pop(response_id)
+        last = len(self.ids) - 1
+        if row != last:
+            moved = self.ids[last]
+            self._raw[row] = self._raw[last]
+            self._normed[row] = self._normed[last]
+            self.ids[row] = moved
+            self._rows[moved] = row
+        self.ids.pop()
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, response_id):
+        return response_id in self._rows
+
+    # matrix access
+    def row(self, response_id):
+        return self._rows[response_id]
+
+    @property
+    def matrix(self):
+        '''raw embeddings, one row per id (view, don't write to it directly)'''
+        if self._raw is None: return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._raw[:len(self.ids)]
+
+    @property
+    def normalized(self):
+        if self._normed is None: return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._normed[:len(self.ids)]
+
+    def set_rows(self, rows, embeddings):
+        '''overwrite several rows at once (batched training updates)'''
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self._raw[rows] = embeddings
+        self._normed[rows] = self._normalize(embeddings)
+
+    def scores(self, query, noise=0.0):
+        '''cosine similarity of query against every row, plus optional gaussian noise'''
+        query = self._normalize(np.asarray(query, dtype=np.float32))
+        scores = self.normalized @ query
+        if noise: scores += np.random.normal(0, noise, len(scores)).astype(np.float32)
+        return scores
+
+    def search(self, query, k=1, noise=0.0):
+        '''top-k (response_id, score) pairs, best first'''
+        if not self.ids: return []
+        scores = self.scores(query, noise)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+    @classmethod
+    def from_matrix(cls, ids, matrix):
+        '''index over a whole (n, dim) matrix at once'''
+        matrix = np.asarray(matrix, dtype=np.float32)
+        index = cls(matrix.shape[1], capacity=max(len(ids), 1))
+        index.ids = list(ids)
+        index._rows = {response_id: row for row, response_id in enumerate(index.ids)}
+        index._raw[:len(ids)] = matrix
+        index._normed[:len(ids)] = cls._normalize(matrix)
+        return index
+
+    def to_dict(self):
+        '''plain dict copy, for pickling'''
+        return {response_id: self[response_id] for response_id in self.ids}
+
+class IVFIndex(EmbeddingIndex):
+    ''' approximate nearest neighbour version of EmbeddingIndex (inverted file):
+        rows are clustered with spherical k-means and a search only scores the rows
+        in the n_probe clusters closest to the query. meant for very large response
+        sets (100k+), below min_size it just does the exact search.
+        inserts/updates are assigned to their nearest centroid as they happen, the
+        clustering itself is retrained once the index has grown a lot.
+    '''
+    def __init__(self, dim=None, capacity=64, n_lists=None, n_probe=8, min_size=5000, kmeans_iters=10):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_size = min_size
+        self.kmeans_iters = kmeans_iters
+        self.centroids = None
+        self._trained_size = 0
+        self._assign = {}   # row -> cluster
+        self._members = []  # cluster -> set of rows
+        self._member_arrays = {}  # cluster -> cached np array of rows
+        super().__init__(dim, capacity)
+
+    # clustering
+    def train(self, seed=0):
+        '''(re)build the clusters from the current rows'''
+        n = len(self.ids)
+        n_lists = self.n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        data = self.normalized
+
+        # k-means on a sample, then assign everything
+        sample = data[rng.choice(n, min(n, n_lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[labels == c]
+                if len(members): centroids[c] = members.sum(axis=0)
+            centroids = self._normalize(centroids)
+        self.centroids = centroids
+
+        labels = self._nearest(data)
+        self._members = [set() for _ in range(n_lists)]
+        self._member_arrays = {}
+        self._assign = {}
+        for row, c in enumerate(labels): self._set_cluster(row, int(c))
+        self._trained_size = n
+
+    def _nearest(self, vectors, chunk=8192):
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            labels[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ self.centroids.T, axis=1)
+        return labels
+
+    def _set_cluster(self, row, cluster):
+        old = self._assign.get(row)
+        if old == cluster: return
+        if old is not None:
+            self._members[old].discard(row)
+            self._member_arrays.pop(old, None)
+        self._assign[row] = cluster
+        self._members[cluster].add(row)
+        self._member_arrays.pop(cluster, None)
+
+    def _drop_row(self, row):
+        old = self._assign.pop(row, None)
+        if old is not None:
+            self._members[old].discard(row)
+            self._member_arrays.pop(old, None)
+
+    def _rows_in(self, cluster):
+        rows = self._member_arrays.get(cluster)
+        if rows is None:
+            rows = np.fromiter(self._members[cluster], dtype=np.int64, count=len(self._members[cluster]))
+            self._member_arrays[cluster] = rows
+        return rows
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def _maybe_train(self):
+        n = len(self.ids)
+        if n < self.min_size: return
+        if not self.trained or n > 4 * self._trained_size: self.train()
+
+    # keep clusters in sync with the mapping
+    def __setitem__(self, response_id, embedding):
+        super().__setitem__(response_id, embedding)
+        if self.trained:
+            row = self._rows[response_id]
+            self._set_cluster(row, int(self._nearest(self._normed[row:row + 1])[0]))
+
+    def __delitem__(self, response_id):
+        row = self._rows[response_id]
+        last = len(self.ids) - 1
+        super().__delitem__(response_id)
+        if self.trained:
+            self._drop_row(row)
+            if row != last:
+                cluster = self._assign.get(last)
+                self._drop_row(last)
+                if cluster is not None: self._set_cluster(row, cluster)
+
+    def set_rows(self, rows, embeddings):
+        super().set_rows(rows, embeddings)
+        if self.trained:
+            rows = np.atleast_1d(np.arange(len(self.ids))[rows])
+            for row, c in zip(rows, self._nearest(self._normed[rows])): self._set_cluster(int(row), int(c))
+
+    def search(self, query, k=1, noise=0.0):
+        '''approximate top-k: only score rows in the closest clusters'''
+        self._maybe_train()
+        if not self.trained or len(self.ids) < self.min_size:
+            return super().search(query, k, noise)
+
+        query = self._normalize(np.asarray(query, dtype=np.float32))
+        n_probe = min(self.n_probe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        rows = np.concatenate([self._rows_in(int(c)) for c in probe])
+        if len(rows) == 0: return []
+
+        scores = self._normed[rows] @ query
+        if noise: scores += np.random.normal(0, noise, len(scores)).astype(np.float32)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+def make_index(config):
+    '''embedding index for the choice system, picked by the choice_index config key'''
+    if config.get('choice_index', 'flat') == 'ivf':
+        return IVFIndex(
+            n_lists=config.get('ivf_lists'),
+            n_probe=config.get('ivf_probe', 8),
+            min_size=config.get('ivf_min_size', 5000)
+        )
+    return EmbeddingIndex()
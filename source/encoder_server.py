@@ -0,0 +1,103 @@
+''' shared sentence model worker: one process holding the model for every bot process
+    (shards, or separate guild sets) on the machine, so MiniLM is in RAM once.
+        python source/encoder_server.py [config.json]
+    listens on encoder_address ("127.0.0.1:50321"), bots with the same encoder_address
+    and encoder_authkey in their config encode through it instead of loading the model.
+    the connection carries pickles, so encoder_authkey is required (a long random secret,
+    e.g. python -c "import secrets; print(secrets.token_hex(32))"): anyone with it can
+    run code in the worker. there's no default, neither side starts without one.
+'''
+import sys
+import json
+import time
+import threading
+from multiprocessing.managers import BaseManager
+from transformer_ram import make_sentence_model
+
+DEFAULT_ADDRESS = '127.0.0.1:50321'
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def parse_authkey(authkey):
+    if not authkey: raise ValueError("encoder_authkey is required for the shared sentence model worker (see encoder_server.py)")
+    return authkey.encode('utf-8')
+
+class SharedEncoder:
+    '''the worker's RAMTransformer behind a lock: the manager serves every connection on its own thread'''
+    def __init__(self, sentence_model):
+        self.sentence_model = sentence_model
+        self._lock = threading.Lock()
+
+    def encode(self, sentences, **kwargs):
+        with self._lock: return self.sentence_model.encode(sentences, **kwargs)
+
+    def release(self):
+        with self._lock: self.sentence_model.release()
+
+    def check_residency(self):
+        with self._lock: self.sentence_model.check_residency()
+
+    def stats(self):
+        with self._lock: return self.sentence_model.stats()
+
+class EncoderClient(BaseManager):
+    pass
+
+EncoderClient.register('encoder')
+
+class RemoteEncoder:
+    ''' RAMTransformer interface for bots, encoding in the shared worker process.
+        residency is the worker's business: release is passed on, check_residency is
+        done by the worker itself.
+    '''
+    def __init__(self, address, authkey):
+        self.address = address
+        self.manager = EncoderClient(address=parse_address(address), authkey=parse_authkey(authkey))
+        self.manager.connect()
+        self._encoder = self.manager.encoder()
+        print(f"Using shared sentence model at {address}")
+
+    def encode(self, sentences, **kwargs):
+        return self._encoder.encode(sentences, **kwargs)
+
+    def release(self):
+        self._encoder.release()
+
+    def check_residency(self):
+        pass
+
+    @property
+    def is_loaded(self):
+        return self.stats()['loaded']
+
+    def stats(self):
+        return self._encoder.stats()
+
+def serve(config, model_factory=None):
+    '''run the worker until killed'''
+    authkey = parse_authkey(config.get('encoder_authkey'))
+    sentence_model = make_sentence_model(config, model_factory)
+    shared = SharedEncoder(sentence_model)
+
+    class EncoderServer(BaseManager):
+        pass
+    EncoderServer.register('encoder', callable=lambda: shared)
+
+    # unload when idle / low on RAM, like the bot's residency loop
+    def residency_loop():
+        while True:
+            time.sleep(30)
+            shared.check_residency()
+    threading.Thread(target=residency_loop, daemon=True).start()
+
+    address = config.get('encoder_address', DEFAULT_ADDRESS)
+    manager = EncoderServer(address=parse_address(address), authkey=authkey)
+    server = manager.get_server()
+    print(f"Sentence model worker listening on {address}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'config.json', 'r', encoding='utf-8') as f:
+        serve(json.load(f))
@@ -0,0 +1,65 @@
+EMOJI_SCORES = {"👍": 1.0, "👎": -1.0, "🟩": 1.5, "🟥": -1.5}
+
+class FeedbackAggregator:
+    ''' exact vote state of the bot's messages: which (user, emoji) reactions are on each
+        one right now. a message's score is the mean value of its votes (default_score
+        without any), so it only depends on the votes that are there, not on the order
+        reactions were added and removed in, and a repeated event changes nothing.
+        vote() only updates the votes and marks the message; flush() hands over the new
+        scores of all changed messages at once (DataManager flushes a burst after a
+        debounce).
+    '''
+    def __init__(self, default_score=1.0):
+        self.default_score = default_score
+        self.votes = {}     # message_id -> {(user_id, emoji)}
+        self.dirty = set()  # message ids with votes changed since the last flush
+
+    def vote(self, message_id, user_id, emoji, is_add):
+        '''add/remove one vote, returns whether anything changed'''
+        emoji = str(emoji)
+        if emoji not in EMOJI_SCORES: return False
+        votes = self.votes.get(message_id)
+        if is_add:
+            if votes is None: votes = self.votes[message_id] = set()
+            if (user_id, emoji) in votes: return False
+            votes.add((user_id, emoji))
+        else:
+            if votes is None or (user_id, emoji) not in votes: return False
+            votes.discard((user_id, emoji))
+            if not votes: del self.votes[message_id]
+        self.dirty.add(message_id)
+        return True
+
+    def score(self, message_id):
+        votes = self.votes.get(message_id)
+        if not votes: return self.default_score
+        return sum(EMOJI_SCORES[emoji] for _, emoji in votes) / len(votes)
+
+    def counts(self, message_id):
+        '''emoji -> number of votes'''
+        counts = {}
+        for _, emoji in self.votes.get(message_id, ()): counts[emoji] = counts.get(emoji, 0) + 1
+        return counts
+
+    def export(self, message_id):
+        '''votes as a plain list (for the feedback log)'''
+        return sorted([user_id, emoji] for user_id, emoji in self.votes.get(message_id, ()))
+
+    def restore(self, message_id, votes):
+        '''votes of a message from export() (log replay), not marked as changed'''
+        if votes: self.votes[message_id] = {(user_id, emoji) for user_id, emoji in votes}
+        else: self.votes.pop(message_id, None)
+
+    def flush(self):
+        '''{message_id: score} of every message changed since the last flush'''
+        dirty, self.dirty = self.dirty, set()
+        return {message_id: self.score(message_id) for message_id in dirty}
+
+    def prune(self, keep):
+        '''forget votes of messages for which keep(message_id) is false (no longer trained on)'''
+        for message_id in [m for m in self.votes if not keep(m)]:
+            del self.votes[message_id]
+            self.dirty.discard(message_id)
+
+    def __len__(self):
+        return len(self.votes)
@@ -0,0 +1,142 @@
+import itertools
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+
+class FeedbackLog:
+    ''' append-only log (SQLite in WAL mode) of everything that goes into the training
+        store: user messages, bot responses and feedback, written as it happens so a
+        crash doesn't lose the feedback collected since the last training run.
+        append() only queues the event, a writer thread commits them in batches
+        (every flush_interval seconds or flush_size events). replay() on startup.
+    '''
+    def __init__(self, path, flush_interval=1.0, flush_size=256):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._marks = itertools.count(1)
+        self.closed = False
+        self.written = 0
+
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                payload BLOB,
+                ts REAL NOT NULL)''')
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')  # fsync on every (batched) commit
+        return conn
+
+    def start(self):
+        '''start the writer thread (after replaying)'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, name='ocky-feedback-log', daemon=True)
+            self._thread.start()
+
+    def append(self, kind, key, payload=None):
+        '''queue an event, never blocks. raises once the log is closed: nothing would write it'''
+        if self.closed: raise RuntimeError(f"feedback log {self.path} is closed, {kind} event not written")
+        self._queue.put(('event', (kind, key, pickle.dumps(payload), time.time())))
+
+    def mark(self):
+        ''' high-water mark of the log: everything appended up to now. take it before a
+            snapshot of the store and pass it to compact()
+        '''
+        mark = next(self._marks)
+        self._queue.put(('mark', mark))
+        return mark
+
+    def compact(self, snapshot, mark):
+        ''' replace the log up to mark with the (kind, key, payload) events snapshot() returns,
+            e.g. the store's contents. snapshot is called (and its events pickled) on the writer
+            thread, after mark, so a big store never stalls the caller. events appended after the
+            mark are kept, after them: replaying them on top of the snapshot has to be harmless
+        '''
+        self._queue.put(('compact', (mark, snapshot)))
+
+    def replay(self):
+        '''yield all logged (kind, key, payload) events in order'''
+        conn = self._connect()
+        try:
+            for kind, key, payload in conn.execute('SELECT kind, key, payload FROM events ORDER BY seq'):
+                try:
+                    yield kind, key, pickle.loads(payload)
+                except Exception as e:
+                    print(f"skipping unreadable log event ({e})")
+        finally:
+            conn.close()
+
+    def close(self):
+        '''flush what's queued and stop the writer'''
+        self.closed = True
+        if self._thread is not None:
+            self._queue.put(('stop', None))
+            self._thread.join()
+            self._thread = None
+
+    def _writer(self):
+        conn = self._connect()
+        batch = []
+        marks = {}  # mark -> last seq at that point
+        last_flush = time.monotonic()
+        stop = False
+        while not stop:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                command, data = self._queue.get(timeout=timeout)
+                if command == 'event': batch.append(data)
+                elif command == 'stop': stop = True
+                elif command == 'mark':
+                    self._commit(conn, batch)
+                    batch = []
+                    marks[data] = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM events').fetchone()[0]
+                elif command == 'compact':
+                    mark, snapshot = data
+                    self._commit(conn, batch)
+                    batch = []
+                    self._compact(conn, marks.pop(mark), snapshot)
+            except queue.Empty:
+                pass
+
+            if batch and (stop or len(batch) >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval):
+                self._commit(conn, batch)
+                batch = []
+                last_flush = time.monotonic()
+            elif not batch:
+                last_flush = time.monotonic()
+        conn.close()
+
+    def _compact(self, conn, high, snapshot):
+        '''events up to seq high -> the snapshot. newer ones are put back after it, so they still replay last'''
+        try:
+            rows = [(kind, key, pickle.dumps(payload), time.time()) for kind, key, payload in snapshot()]
+        except Exception as e:
+            print(f"Error compacting feedback log: {e}")
+            return
+        try:
+            with conn:
+                newer = conn.execute('SELECT kind, key, payload, ts FROM events WHERE seq > ? ORDER BY seq', (high,)).fetchall()
+                conn.execute('DELETE FROM events')
+                conn.executemany('INSERT INTO events (kind, key, payload, ts) VALUES (?, ?, ?, ?)', rows + newer)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            print(f"Error compacting feedback log: {e}")
+
+    def _commit(self, conn, batch):
+        if not batch: return
+        try:
+            with conn:
+                conn.executemany('INSERT INTO events (kind, key, payload, ts) VALUES (?, ?, ?, ?)', batch)
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            print(f"Error writing feedback log: {e}")
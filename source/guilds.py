@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import shutil
+import threading
+from collections import OrderedDict
+import data
+import training
+import response_sys
+import choice_sys
+
+def reload_systems(context, module, sentence_model, inference):
+    ''' rebuild one system of a context (OCKYBot or GuildContext) from its reloaded module,
+        handing the old instance's state over: models, embeddings, training data, the
+        feedback log and a training run in progress carry over, nothing is read or
+        encoded again.
+    '''
+    match module:
+        case "response":
+            context.response_system = response_sys.ResponseSystem(
+                context.config, context.data_manager, sentence_model, previous=context.response_system
+            )
+        case "choice":
+            context.choice_system = choice_sys.ChoiceSystem(
+                context.config, context.data_manager, sentence_model, context.responses, previous=context.choice_system
+            )
+        case "training":
+            context.training_manager = training.TrainingManager(
+                context.config, context.data_manager, inference, previous=context.training_manager
+            )
+        case "data":
+            context.data_manager = data.DataManager(context.config, previous=context.data_manager)
+            for system in (context.response_system, context.choice_system, context.training_manager):
+                system.data_manager = context.data_manager
+
+class GuildContext:
+    ''' everything one community has for itself: responses, training data, response
+        classifier and response embeddings. the sentence model, inference thread and
+        training process are shared with the other guilds.
+        same attribute names as OCKYBot, which is the (only) context outside guild mode.
+    '''
+    def __init__(self, guild_id, config, sentence_model, inference, training_pool=None):
+        self.guild_id = guild_id
+        self.config = config
+        self.channel_id = config.get('channel')
+        with open(config.get('response_file', 'responses.json'), 'r', encoding='utf-8') as f:
+            self.responses = json.load(f)
+
+        self.data_manager     = data.DataManager(config)
+        self.training_manager = training.TrainingManager(config, self.data_manager, inference, training_pool)
+        self.response_system  = response_sys.ResponseSystem(config, self.data_manager, sentence_model)
+        self.choice_system    = choice_sys.ChoiceSystem(config, self.data_manager, sentence_model, self.responses)
+        self.last_used = time.time()
+
+    @property
+    def closed(self):
+        return self.data_manager.closed
+
+    def close(self):
+        self.training_manager.shutdown()
+        self.data_manager.close()
+
+class GuildRegistry:
+    ''' guild mode (config "guilds"): per guild config overrides, {"<guild id>": {...}},
+        with "*" as the entry for guilds that aren't listed. each guild gets its own
+        models dir (models_dir/guilds/<id>) and response file in it (a copy of the global
+        one at first), unless given. the bot channel is only taken from the guild's own
+        entry: channel ids belong to one guild. without one it responds in any channel.
+        contexts are built on a guild's first message and closed again after
+        guild_idle_timeout seconds without messages, or when more than max_loaded_guilds
+        are loaded (least recently used first, never the one being loaded). they're closed
+        on the event loop, which owns their votes. their training data is in the feedback
+        log and the models in checkpoints, so nothing is lost on eviction. a handler
+        still holding an evicted context gets an error on its next write, not silence.
+    '''
+    def __init__(self, config, sentence_model, inference):
+        self.config = config
+        self.guild_configs = config.get('guilds', {})
+        self.sentence_model = sentence_model
+        self.inference = inference
+        self.idle_timeout = config.get('guild_idle_timeout', 3600)
+        self.max_loaded = config.get('max_loaded_guilds', 0)  # 0: no limit
+        self._contexts = OrderedDict()  # guild_id -> GuildContext, least recently used first
+        self._lock = threading.Lock()       # _contexts: the event loop looks up, the inference thread loads/evicts
+        self._load_lock = threading.Lock()  # one context built at a time
+        self._closing = {}  # guild_id -> threading.Event, set once its evicted context is closed
+
+        # one training process for all guilds
+        self.training_pool = training.training_pool() if config.get('training_process', 1) == 1 else None
+
+    def guild_config(self, guild_id):
+        '''config for a guild, None if it isn't served'''
+        overrides = self.guild_configs.get(str(guild_id), self.guild_configs.get('*'))
+        if guild_id is None or overrides is None: return None
+        guild_config = {key: value for key, value in self.config.items() if key not in ('guilds', 'channel')}
+        guild_config['models_dir'] = os.path.join(self.config.get('models_dir', 'source/models'), 'guilds', str(guild_id))
+        guild_config['response_file'] = os.path.join(guild_config['models_dir'], 'responses.json')
+        guild_config.update(overrides)
+        if 'channel' not in self.guild_configs.get(str(guild_id), {}): guild_config.pop('channel', None)
+        return guild_config
+
+    def _seed_responses(self, guild_config):
+        '''a guild's own response file starts as a copy of the global one'''
+        path = guild_config['response_file']
+        if os.path.exists(path): return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        shutil.copyfile(self.config.get('response_file', 'responses.json'), path)
+
+    def get(self, guild_id):
+        '''the loaded context of a guild, None if it isn't loaded'''
+        with self._lock:
+            context = self._contexts.get(guild_id)
+            if context is not None:
+                context.last_used = time.time()
+                self._contexts.move_to_end(guild_id)
+            return context
+
+    def load(self, guild_id, loop=None):
+        ''' context of a guild, built if needed (slow: run it on the inference thread). None if not served.
+            loop: the event loop to close evicted contexts on (see _close)
+        '''
+        with self._load_lock:
+            context = self.get(guild_id)
+            if context is not None: return context
+            guild_config = self.guild_config(guild_id)
+            if guild_config is None: return None
+            closing = self._closing.get(guild_id)
+            if closing is not None: closing.wait()  # evicted just now, its log isn't closed yet
+
+            start = time.perf_counter()
+            self._seed_responses(guild_config)
+            context = GuildContext(guild_id, guild_config, self.sentence_model, self.inference, self.training_pool)
+            with self._lock:
+                self._contexts[guild_id] = context
+                evicted = self._evict(lambda context: len(self._contexts) > self.max_loaded, keep=guild_id) if self.max_loaded else []
+            print(f"Loaded guild {guild_id} ({time.perf_counter() - start:.2f}s, {len(self._contexts)} loaded)")
+            self._close(evicted, loop)
+            return context
+
+    def loaded(self):
+        with self._lock: return list(self._contexts.values())
+
+    def evict_idle(self, loop=None):
+        now = time.time()
+        with self._lock: evicted = self._evict(lambda context: now - context.last_used > self.idle_timeout)
+        self._close(evicted, loop)
+
+    def _evict(self, should_evict, keep=None):
+        ''' take least recently used contexts out while should_evict(context), skipping ones
+            that are training and guild keep (the one being loaded). (under _lock) returns
+            them, to be closed after
+        '''
+        evicted = []
+        for guild_id, context in list(self._contexts.items()):
+            if not should_evict(context): break
+            if guild_id == keep: continue
+            if context.training_manager.running:
+                self._contexts.move_to_end(guild_id)
+                continue
+            del self._contexts[guild_id]
+            self._closing[guild_id] = threading.Event()
+            evicted.append((guild_id, context))
+        return evicted
+
+    def _close(self, evicted, loop=None):
+        ''' close evicted contexts. given the event loop, they're closed on it: closing flushes
+            the votes, which the loop changes (and its flush timer belongs to the loop)
+        '''
+        if loop is not None and evicted:
+            loop.call_soon_threadsafe(self._close, evicted)
+            return
+        for guild_id, context in evicted:
+            try: context.close()
+            finally:
+                with self._lock: self._closing.pop(guild_id).set()
+            print(f"Unloaded guild {guild_id} (idle {time.time() - context.last_used:.0f}s)")
+
+    def close_all(self):
+        with self._lock:
+            contexts = list(self._contexts.values())
+            self._contexts.clear()
+        for context in contexts: context.close()
+
+    def shutdown(self):
+        self.close_all()
+        if self.training_pool is not None: self.training_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,106 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Histogram
+
+class Overloaded(Exception):
+    '''raised when low priority work is dropped because the inference queue is full'''
+
+class InferenceExecutor:
+    ''' runs model work (sentence encoding, sklearn predictions) on one worker thread
+        that owns the model, so the discord event loop (heartbeats, other channels)
+        never blocks on it. callers await run().
+        backpressure: low priority work (scoring every message) is dropped once
+        low_priority_limit jobs are pending, high priority work (actually replying)
+        waits for a free slot below max_pending instead.
+    '''
+    def __init__(self, max_pending=32, low_priority_limit=None):
+        self.max_pending = max_pending
+        self.low_priority_limit = low_priority_limit or max(1, max_pending // 2)
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ocky-inference')
+        self._slots = None  # semaphore, made on first use inside the event loop
+
+        # stats
+        self.pending = 0
+        self.completed = 0
+        self.dropped = 0
+
+    async def run(self, fn, *args, low_priority=False, **kwargs):
+        '''run fn(*args, **kwargs) on the inference thread and await its result'''
+        if low_priority and self.pending >= self.low_priority_limit:
+            self.dropped += 1
+            raise Overloaded(f"{self.pending} inference jobs pending")
+
+        if self._slots is None: self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+            finally:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        return {'pending': self.pending, 'completed': self.completed, 'dropped': self.dropped}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+class MicroBatcher:
+    ''' collects encode requests for up to max_wait_ms or max_batch texts, then runs
+        a single batched encode on the inference executor and hands every caller its
+        own row. lets bursts across channels share one forward pass.
+    '''
+    def __init__(self, sentence_model, executor, max_batch=16, max_wait_ms=5):
+        self.sentence_model = sentence_model
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = []  # (text, future, queued_at, low_priority)
+        self._timer = None
+        self._tasks = set()  # running batches (keep a reference until done)
+
+        # stats
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.wait_ms = Histogram([1, 2, 5, 10, 25, 50, 100, 250])
+
+    async def encode(self, text, low_priority=False):
+        '''embedding for a single text, batched together with other callers'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((text, future, time.perf_counter(), low_priority))
+
+        if len(self._queue) >= self.max_batch: self._flush()
+        elif self._timer is None: self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if not batch: return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        texts = [text for text, _, _, _ in batch]
+        low_priority = all(low for _, _, _, low in batch)
+        try:
+            embeddings = await self.executor.run(self.sentence_model.encode, texts, low_priority=low_priority)
+        except Exception as e:
+            for _, future, _, _ in batch:
+                if not future.done(): future.set_exception(e)
+            return
+
+        now = time.perf_counter()
+        self.batch_sizes.observe(len(batch))
+        for (_, future, queued_at, _), embedding in zip(batch, embeddings):
+            self.wait_ms.observe((now - queued_at) * 1000)
+            if not future.done(): future.set_result(embedding)
+
+    def stats(self):
+        return {'batch_size': self.batch_sizes.snapshot(), 'wait_ms': self.wait_ms.snapshot()}
@@ -1,31 +1,129 @@
 import json
+import time
 import importlib
-from transformer_ram import RAMTransformer
+from transformer_ram import make_sentence_model
 import asyncio
 import bot_logic
 import response_sys
 import choice_sys
 import training
 import data
+import inference
+import guilds
+from encoder_server import RemoteEncoder
+from metrics import metrics
 
 class OCKYBot:
-    def __init__(self, config_file="config.json"):
+    def __init__(self, config_file="config.json", config=None, model_factory=None):
         # load config, responses and transformer
-        self.config = self.load_json(config_file)
+        self.config = config if config is not None else self.load_json(config_file)
         self.responses = self.load_json(self.config.get('response_file', 'responses.json'))
-        self.sentence_model = RAMTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+        metrics.enabled = self.config.get('metrics', 0) == 1
+        if self.config.get('encoder_address'):
+            # shared sentence model worker (encoder_server.py), one model for all bot processes
+            self.sentence_model = RemoteEncoder(self.config['encoder_address'], self.config.get('encoder_authkey'))
+        else: self.sentence_model = make_sentence_model(self.config, model_factory)
 
-        # initialize systems
-        self.data_manager     = data.DataManager(self.config)
-        self.training_manager = training.TrainingManager(self.config, self.data_manager)
-        self.response_system  = response_sys.ResponseSystem(self.config, self.data_manager, self.sentence_model)
-        self.choice_system    = choice_sys.ChoiceSystem(self.config, self.data_manager, self.sentence_model, self.responses)
-        self.discord_handler  = bot_logic.DiscordHandler(self.config, self.data_manager, self)
-        self.sentence_model.unload() # remove from RAM
+        # model work runs off the event loop
+        self.inference = inference.InferenceExecutor(self.config.get('inference_max_pending', 32))
+        self.batcher = inference.MicroBatcher(
+            self.sentence_model, self.inference,
+            max_batch=self.config.get('encode_batch_max', 16),
+            max_wait_ms=self.config.get('encode_batch_wait_ms', 5)
+        )
+
+        # initialize systems. guild mode: per guild systems, loaded when a guild needs them
+        self.guilds = None
+        if self.config.get('guilds'):
+            self.guilds = guilds.GuildRegistry(self.config, self.sentence_model, self.inference)
+        else:
+            self.data_manager     = data.DataManager(self.config)
+            self.training_manager = training.TrainingManager(self.config, self.data_manager, self.inference)
+            self.response_system  = response_sys.ResponseSystem(self.config, self.data_manager, self.sentence_model)
+            self.choice_system    = choice_sys.ChoiceSystem(self.config, self.data_manager, self.sentence_model, self.responses)
+        self.discord_handler  = bot_logic.DiscordHandler(self.config, self)
+        self.sentence_model.release() # free RAM according to residency policy
 
         # misc
         self.bot = self.discord_handler.bot
-        self.channel_id = self.config['channel']
+        self.channel_id = self.config.get('channel')
+        if metrics.enabled: self._register_metrics()
+
+    def context(self, guild_id):
+        '''systems of a guild if loaded (None if not). outside guild mode the bot itself, for every guild'''
+        if self.guilds is None: return self
+        return self.guilds.get(guild_id)
+
+    async def get_context(self, guild_id):
+        '''context(), loading the guild's systems (on the inference thread) if needed. None if not served'''
+        context = self.context(guild_id)
+        if context is None and self.guilds.guild_config(guild_id) is not None:
+            context = await self.inference.run(self.guilds.load, guild_id, asyncio.get_running_loop())
+        return context
+
+    def contexts(self):
+        '''every loaded context'''
+        return [self] if self.guilds is None else self.guilds.loaded()
+
+    def _register_metrics(self):
+        '''expose the stats the systems already keep. read through self at scrape time,
+           so reloaded systems are picked up'''
+        def collect():
+            model = self.sentence_model.stats()
+            queue = self.inference.stats()
+            samples = [
+                ('ocky_model_loaded', 'gauge', int(model['loaded']), {}),
+                ('ocky_model_loads_total', 'counter', model['load_count'], {}),
+                ('ocky_model_unloads_total', 'counter', model['unload_count'], {}),
+                ('ocky_model_load_seconds_total', 'counter', model['load_time'], {}),
+                ('ocky_embedding_cache_size', 'gauge', model['cache']['size'], {}),
+                ('ocky_embedding_cache_hits_total', 'counter', model['cache']['hits'], {}),
+                ('ocky_embedding_cache_misses_total', 'counter', model['cache']['misses'], {}),
+                ('ocky_embedding_cache_hit_rate', 'gauge', model['cache']['hit_rate'], {}),
+                ('ocky_inference_pending', 'gauge', queue['pending'], {}),
+                ('ocky_inference_completed_total', 'counter', queue['completed'], {}),
+                ('ocky_inference_dropped_total', 'counter', queue['dropped'], {}),
+                ('ocky_encode_batch_queue', 'gauge', len(self.batcher._queue), {}),
+                ('ocky_reaction_queue', 'gauge', self.discord_handler.reactions.pending, {})
+            ]
+            if model.get('disk_cache'):
+                samples += [
+                    ('ocky_disk_cache_size', 'gauge', model['disk_cache']['size'], {}),
+                    ('ocky_disk_cache_hits_total', 'counter', model['disk_cache']['hits'], {}),
+                    ('ocky_disk_cache_misses_total', 'counter', model['disk_cache']['misses'], {}),
+                    ('ocky_disk_cache_corrupt_total', 'counter', model['disk_cache']['corrupt'], {})
+                ]
+            if self.guilds is not None: samples.append(('ocky_loaded_guilds', 'gauge', len(self.guilds.loaded()), {}))
+            for context in self.contexts():
+                labels = {} if self.guilds is None else {'guild': str(context.guild_id)}
+                store = context.data_manager.store.stats()
+                training_manager = context.training_manager
+                samples += [
+                    ('ocky_training_running', 'gauge', int(training_manager.running), labels),
+                    ('ocky_training_runs_total', 'counter', training_manager.runs, labels),
+                    ('ocky_training_records', 'gauge', store['respond_requests'], dict(labels, kind='respond_requests')),
+                    ('ocky_training_records', 'gauge', store['bot_responses'], dict(labels, kind='bot_responses')),
+                    ('ocky_training_records_evicted_total', 'counter', store['evicted'], labels),
+                    ('ocky_active_channels', 'gauge', len(context.data_manager.activity), labels)
+                ]
+                if training_manager.last_duration is not None:
+                    samples.append(('ocky_training_last_seconds', 'gauge', training_manager.last_duration, labels))
+                samples += [('ocky_decisions_total', 'counter', n, dict(labels, stage=stage)) for stage, n in context.response_system.stage_counts.items()]
+            for name, histogram in (('batch_size', self.batcher.batch_sizes), ('wait_ms', self.batcher.wait_ms)):
+                samples.append((f'ocky_encode_batch_{name}_mean', 'gauge', histogram.snapshot()['mean'], {}))
+            return samples
+
+        metrics.collect(collect, help={
+            'ocky_encode_seconds': "sentence model encode calls (cache misses only)",
+            'ocky_classify_seconds': "response classifier prediction",
+            'ocky_choose_seconds': "choice system: embed message + search responses",
+            'ocky_send_seconds': "sending a reply (its reactions are added in the background)",
+            'ocky_reply_seconds': "user message to bot reply, by discord timestamps",
+            'ocky_reactions_total': "seed reactions on replies, by result",
+            'ocky_feedback_seconds': "processing a feedback reaction",
+            'ocky_training_seconds': "full training run, snapshot to swap",
+            'ocky_decisions_total': "messages per stage of the respond decision"
+        })
 
     def load_json(self, filename):
         '''load dict from JSON file'''
@@ -38,25 +136,31 @@ class OCKYBot:
 
     async def shutdown(self):
         print("shutting down...")
-        if self.config['training'] == 1:
+        if self.config.get('training', 0) == 1 and self.channel_id:
             channel = self.bot.get_channel(self.channel_id)
             await channel.edit(topic='**STATUS: OFFLINE**')
+        if self.discord_handler.metrics_server is not None: await self.discord_handler.metrics_server.stop()
+        self.discord_handler.reactions.close()
         await self.bot.close()
+        self.inference.shutdown()
+        if self.guilds is not None: self.guilds.shutdown()
+        else:
+            self.training_manager.shutdown()
+            self.data_manager.close()
 
-    def reload(self, module):
-        match module:
-            case "response": 
-                importlib.reload(response_sys)
-                self.response_system  = response_sys.ResponseSystem(self.config, self.data_manager, self.sentence_model)
-            case "choice": 
-                importlib.reload(choice_sys)
-                self.choice_system = choice_sys.ChoiceSystem(self.config, self.data_manager, self.sentence_model, self.responses)
-            case "training": 
-                importlib.reload(training)
-                self.training_manager = training.TrainingManager(self.config, self.data_manager)
-            case "data": 
-                importlib.reload(data)
-                self.data_manager = data.DataManager(self.config)
+    async def reload(self, module):
+        ''' reload a module's code and rebuild its system in every loaded context, keeping their
+            state. rebuilds run on the inference thread, so never halfway a prediction (or a
+            training run's swap, which looks the new systems up)
+        '''
+        modules = {'response': response_sys, 'choice': choice_sys, 'training': training, 'data': data}
+        if module not in modules: return False
+        start = time.perf_counter()
+        importlib.reload(modules[module])
+        for context in self.contexts():
+            await self.inference.run(guilds.reload_systems, context, module, self.sentence_model, self.inference)
+        print(f"Reloaded {module} in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return True
 
 if __name__ == "__main__":
     # read token
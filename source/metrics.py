@@ -0,0 +1,183 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# default latency buckets, in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+class Histogram:
+    '''fixed bucket histogram: counts of observations <= each upper bound'''
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self):
+        labels = [str(b) for b in self.buckets] + ['+inf']
+        return {
+            'buckets': dict(zip(labels, self.counts)),
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0
+        }
+
+    def prometheus(self, name):
+        lines, cumulative = [], 0
+        for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum {self.total}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics:
+    ''' counters and histograms for the hot path, plus collectors: functions read at
+        scrape time for everything that's already counted somewhere (model loads,
+        cache hits, queue depths), so those cost nothing in between.
+        disabled (the default) inc/observe return right away and timer() hands out
+        one shared no-op context manager.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # name -> Histogram
+        self.collectors = []  # fn() -> [(name, type, value, labels)]
+        self.help = {}
+        self._lock = threading.Lock()  # observations come from the inference thread too
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        if not self.enabled: return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None: histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name):
+        '''with metrics.timer('ocky_encode_seconds'): ... observes the duration in seconds'''
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def collect(self, fn, help=None):
+        '''register fn() -> [(name, 'counter' | 'gauge', value, {labels})], read on every scrape'''
+        self.collectors.append(fn)
+        if help: self.help.update(help)
+
+    def _collected(self):
+        samples = []
+        for fn in self.collectors:
+            try: samples.extend(fn())
+            except Exception as e: print(f"metrics collector failed: {e}")
+        return samples
+
+    def snapshot(self):
+        '''everything as a plain dict (for the JSON dump)'''
+        with self._lock:
+            counters = [(name, 'counter', value, dict(labels)) for (name, labels), value in self.counters.items()]
+            histograms = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        snapshot = {'time': time.time(), 'metrics': {}, 'histograms': histograms}
+        for name, _, value, labels in counters + self._collected():
+            key = name + ''.join(f',{k}={v}' for k, v in sorted(labels.items()))
+            snapshot['metrics'][key] = value
+        return snapshot
+
+    def prometheus(self):
+        '''everything in the prometheus text format'''
+        with self._lock:
+            samples = [(name, 'counter', value, dict(labels)) for (name, labels), value in self.counters.items()]
+            histograms = [(name, list(histogram.prometheus(name))) for name, histogram in sorted(self.histograms.items())]
+        samples += self._collected()
+
+        lines, typed = [], set()
+        for name, kind, value, labels in sorted(samples, key=lambda s: s[0]):
+            if name not in typed:
+                if name in self.help: lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                typed.add(name)
+            label_text = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            lines.append(f'{name}{{{label_text}}} {float(value)}' if label_text else f'{name} {float(value)}')
+        for name, histogram_lines in histograms:
+            if name in self.help: lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            lines.extend(histogram_lines)
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, path):
+        '''write snapshot() to path (atomically)'''
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+        self.collectors.clear()
+
+metrics = Metrics()
+
+class MetricsServer:
+    ''' local HTTP endpoint: GET /metrics (prometheus text) and /metrics.json.
+        runs on the bot's own event loop through aiohttp (which discord.py already uses).
+    '''
+    def __init__(self, registry=metrics, host='127.0.0.1', port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self._prometheus)
+        app.router.add_get('/metrics.json', self._json)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _prometheus(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.prometheus(), content_type='text/plain', charset='utf-8')
+
+    async def _json(self, request):
+        from aiohttp import web
+        return web.json_response(self.registry.snapshot())
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
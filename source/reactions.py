@@ -0,0 +1,97 @@
+import asyncio
+from collections import deque
+import discord
+from metrics import metrics
+
+SEED_REACTIONS = ['🟩', '👍', '👎', '🟥']
+
+class ReactionQueue:
+    ''' the bot's own seed reactions on its replies, added in the background so sending a
+        reply doesn't wait for four more API calls.
+        discord rate limits reactions per channel, so there's one worker per channel with
+        work to do, adding at most one reaction every `interval` seconds. a rate limited
+        reaction is retried after retry_after (up to `retries` times), other errors (message
+        deleted, no permission) drop it. past max_pending queued reactions new ones are
+        dropped: they're a convenience for voters, the reply itself is already out.
+    '''
+    def __init__(self, interval=0.25, max_pending=500, retries=3):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self._queues = {}   # channel_id -> deque of (message, emoji)
+        self._workers = {}  # channel_id -> worker task
+        self.pending = 0
+
+        # stats
+        self.added = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def add(self, message, emojis=SEED_REACTIONS):
+        '''queue reactions on a message, never blocks'''
+        channel_id = message.channel.id
+        queue = self._queues.setdefault(channel_id, deque())
+        for emoji in emojis:
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                metrics.inc('ocky_reactions_total', result='dropped')
+                continue
+            queue.append((message, emoji))
+            self.pending += 1
+        if queue and channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.ensure_future(self._worker(channel_id))
+
+    async def _worker(self, channel_id):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                message, emoji = queue.popleft()
+                self.pending -= 1
+                await self._add_reaction(message, emoji)
+                await asyncio.sleep(self.interval)
+        finally:
+            # nothing awaits between the last check and here, so no reaction gets stranded
+            del self._workers[channel_id]
+            if not queue: del self._queues[channel_id]
+
+    async def _add_reaction(self, message, emoji):
+        for attempt in range(self.retries + 1):
+            try:
+                await message.add_reaction(emoji)
+                self.added += 1
+                metrics.inc('ocky_reactions_total', result='added')
+                return
+            except discord.RateLimited as e:
+                retry_after = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    self.failed += 1
+                    metrics.inc('ocky_reactions_total', result='failed')
+                    print(f"Can't add reaction {emoji}: {e}")
+                    return
+                retry_after = None
+            if attempt == self.retries: break
+            self.rate_limited += 1
+            metrics.inc('ocky_reactions_total', result='rate_limited')
+            await asyncio.sleep(retry_after or self.interval * 2 ** (attempt + 1))
+        self.failed += 1
+        metrics.inc('ocky_reactions_total', result='failed')
+        print(f"Can't add reaction {emoji}: still rate limited after {self.retries} retries")
+
+    async def join(self):
+        '''wait until everything queued so far is added (or dropped)'''
+        while self._workers: await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def close(self):
+        for worker in list(self._workers.values()): worker.cancel()
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'channels': len(self._workers),
+            'added': self.added,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited
+        }
@@ -1,38 +1,131 @@
 import time
 import numpy as np
 from datetime import datetime
+from metrics import metrics
+
+BASE_FEATURES = 8    # length of basic_features, see _extract_message_features
+WINDOW_FEATURES = 2  # messages last minute / last 10 minutes, with config activity_window_features
+PER_HOUR = 3         # column of messages per hour, the window counts are estimated from it
+
+def feature_count(config):
+    return BASE_FEATURES + (WINDOW_FEATURES if config.get('activity_window_features', 0) == 1 else 0)
+
+def migrate_features(features, n_features):
+    ''' feature rows (or one row) of the other feature set: the window counts are estimated
+        from messages per hour when added, cut off when removed
+    '''
+    features = np.asarray(features)
+    if features.shape[-1] == n_features: return features
+    if n_features == BASE_FEATURES + WINDOW_FEATURES and features.shape[-1] == BASE_FEATURES:
+        per_hour = features[..., PER_HOUR:PER_HOUR + 1]
+        return np.concatenate([features, per_hour / 60, per_hour / 6], axis=-1).astype(features.dtype)
+    return features[..., :n_features]
 
 class ResponseSystem():
     '''response system: decide if it should respond'''
-    def __init__(self, config, data_manager, sentence_model):
+
+    def __init__(self, config, data_manager, sentence_model, previous=None):
         self.config = config
         self.data_manager = data_manager
         self.sentence_model = sentence_model
-        self.response_classifier = data_manager.load_response_classifier()
-        self.feature_scaler = data_manager.load_feature_scaler()    
+        self.feature_count = feature_count(config)
+        if previous is not None:
+            # hot reload: keep the current models instead of loading the saved ones
+            self.response_classifier = previous.response_classifier
+            self.feature_scaler = previous.feature_scaler
+        else:
+            self.response_classifier = data_manager.load_response_classifier()
+            self.feature_scaler = data_manager.load_feature_scaler()    
+        self._check_feature_count()
+
+        # respond when the classifier says more than this
+        self.threshold = config.get('respond_threshold', 0.5)
+
+        # how many messages stopped at each stage of the decision
+        self.stage_counts = {
+            'received': 0,          # all messages
+            'other_channel': 0,     # not in the bot channel: features recorded, nothing else
+            'overloaded': 0,        # no room on the inference thread: features recorded, nothing else
+            'untrained': 0,         # no classifier yet
+            'training_mode': 0,     # config training: never respond
+            'below_threshold': 0,   # classifier said no
+            'passed': 0             # on to the embedding + choice system
+        }
+        if previous is not None:
+            for stage, count in previous.stage_counts.items():
+                if stage in self.stage_counts: self.stage_counts[stage] = count
+
+    def _check_feature_count(self):
+        ''' models made with the other feature set (activity_window_features switched) are
+            migrated: the window features get scaler stats derived from messages per hour
+            and a weight of 0, so predictions don't change until the next training run.
+            (the training data is migrated as it's loaded.) anything else starts fresh
+        '''
+        n_features = getattr(self.feature_scaler, 'n_features_in_', self.feature_count)
+        if n_features == self.feature_count: pass
+        elif {n_features, self.feature_count} == {BASE_FEATURES, BASE_FEATURES + WINDOW_FEATURES}:
+            print(f"Feature set changed ({n_features} -> {self.feature_count}), migrating response models.")
+            self._migrate_models(n_features)
+        else:
+            print(f"Feature set changed ({n_features} -> {self.feature_count}), starting response models fresh.")
+            self.response_classifier = type(self.response_classifier)(**self.response_classifier.get_params())
+            self.feature_scaler = type(self.feature_scaler)()
+        self.data_manager.store.respond_requests.require_shape('features', (self.feature_count,))
+
+    def _migrate_models(self, n_features):
+        scaler, classifier = self.feature_scaler, self.response_classifier
+        if self.feature_count < n_features:
+            # dropping the window features: their weights go (approximate until retrained)
+            for attr in ('mean_', 'var_', 'scale_'): setattr(scaler, attr, getattr(scaler, attr)[:self.feature_count])
+            if hasattr(classifier, 'coef_'): classifier.coef_ = classifier.coef_[:, :self.feature_count]
+        else:
+            # adding them: x / k has mean / k and scale / k, and no weight yet
+            k = np.array([60.0, 6.0])
+            scaler.mean_ = np.concatenate([scaler.mean_, scaler.mean_[PER_HOUR] / k])
+            scaler.var_ = np.concatenate([scaler.var_, scaler.var_[PER_HOUR] / k ** 2])
+            scaler.scale_ = np.concatenate([scaler.scale_, scaler.scale_[PER_HOUR] / k if scaler.var_[PER_HOUR] > 0 else np.ones(2)])
+            if hasattr(classifier, 'coef_'):
+                classifier.coef_ = np.concatenate([classifier.coef_, np.zeros((classifier.coef_.shape[0], WINDOW_FEATURES))], axis=1)
+        scaler.n_features_in_ = self.feature_count
+        if hasattr(classifier, 'coef_'): classifier.n_features_in_ = self.feature_count
 
-    def should_respond(self, message, bot_user):
-        ''' decide if it should respond based on given message
-            Returns float between 0 and 1.
+    def should_respond(self, message, bot_user, skip=None):
+        ''' decide if it should respond based on given message, from cheap scalar features only
+            (no sentence embedding). Returns float between 0 and 1.
+            skip: why the classifier isn't run ('other_channel', 'overloaded'), the message is
+            only recorded as a training point
         '''
+        self.stage_counts['received'] += 1
+
         # get features from message
         features = self._extract_message_features(message, bot_user)
         
         # register as training point
         self.data_manager.record_user_message(message, features)
 
+        # not a channel we respond in (or no time to classify): only wanted the training point
+        if skip is not None:
+            self.stage_counts[skip] += 1
+            return 0.0
+
         # model not trained yet: never respond to messages
-        if (not hasattr(self.response_classifier, 'coef_')): return 0.0
+        if (not hasattr(self.response_classifier, 'coef_')):
+            self.stage_counts['untrained'] += 1
+            return 0.0
         
         # use trained model
-        basic_scaled = self.feature_scaler.transform([features['basic_features']])
-        probability = self.response_classifier.predict_proba(basic_scaled)[0][1]
+        with metrics.timer('ocky_classify_seconds'):
+            basic_scaled = self.feature_scaler.transform([features['basic_features']])
+            probability = self.response_classifier.predict_proba(basic_scaled)[0][1]
 
         # is training? then don't respond but print the respond result
         if (self.config.get('training', 0) == 1):
             print(f"respond? {probability}")
+            self.stage_counts['training_mode'] += 1
             return 0.0
 
+        if probability <= self.threshold: self.stage_counts['below_threshold'] += 1
+        else: self.stage_counts['passed'] += 1
         return probability
     
     def _extract_message_features(self, message, bot_user):
@@ -45,13 +138,15 @@ class ResponseSystem():
         features.append(len(message.content))                               # message length
         features.append(len(message.content.split()))                       # amount of words
         features.append(time.time() - self.data_manager.prev_response.get(channel_id, 0))  # time since last bot response
-        features.append(len(self.data_manager.msg_activity[channel_id]))     # messages per hour
+        per_minute, per_10_minutes, per_hour = self.data_manager.activity.counts(channel_id)
+        features.append(per_hour)                                            # messages per hour
         features.append(1 if any(word in message.content.lower() for word in q_words) else 0) # question
         features.append(1 if bot_user in message.mentions else 0)           # has mention to bot
         features.append(1 if len(message.content) < 10 else 0)              # really short
         features.append(1 if datetime.now().weekday() >= 5 else 0)          # is it weekend
+        if self.feature_count > BASE_FEATURES:
+            features.append(per_minute)                                      # messages last minute
+            features.append(per_10_minutes)                                  # messages last 10 minutes
 
-        # message embedding
-        embedding = self.sentence_model.encode(message.content)
-
-        return {'basic_features': np.array(features), 'embedding': embedding, 'message': message}
+        # no message embedding here: that's only computed for messages that get past the classifier
+        return {'basic_features': np.array(features), 'message': message}
@@ -0,0 +1,192 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class ColumnBuffer:
+    ''' growable numpy array, one row per record. capacity doubles when full so
+        appends are amortized O(1), view() is a zero-copy slice of the filled rows.
+        can be saved as .npy and loaded back memory-mapped (copied on first write).
+        not locked itself: RecordCollection only touches its buffers under its lock.
+    '''
+    def __init__(self, dtype=np.float32, capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.row_shape = None
+        self._capacity = capacity
+        self._data = None
+        self._size = 0
+
+    def _ensure_capacity(self, row_shape):
+        if self._data is None:
+            self.row_shape = row_shape
+            self._data = np.zeros((self._capacity,) + row_shape, dtype=self.dtype)
+        elif row_shape != self.row_shape:
+            raise ValueError(f"row shape {row_shape} doesn't match column shape {self.row_shape}")
+        if self._size == len(self._data) or not self._data.flags.writeable:
+            grown = np.zeros((max(2 * len(self._data), self._capacity),) + self.row_shape, dtype=self.dtype)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+
+    def append(self, value):
+        '''add a row, returns its index'''
+        value = np.asarray(value, dtype=self.dtype)
+        self._ensure_capacity(value.shape)
+        self._data[self._size] = value
+        self._size += 1
+        return self._size - 1
+
+    def __getitem__(self, row):
+        return self._data[:self._size][row]
+
+    def __setitem__(self, row, value):
+        if not self._data.flags.writeable: self._ensure_capacity(self.row_shape)
+        self._data[:self._size][row] = value
+
+    def __len__(self):
+        return self._size
+
+    def view(self):
+        '''the filled rows, without copying'''
+        if self._data is None: return np.zeros((0,), dtype=self.dtype)
+        return self._data[:self._size]
+
+    def take(self, rows):
+        '''new buffer holding only the given rows'''
+        buffer = ColumnBuffer(self.dtype, max(self._capacity, len(rows)))
+        if self._data is not None:
+            buffer.row_shape = self.row_shape
+            buffer._data = np.zeros((max(len(rows), 1) * 2,) + self.row_shape, dtype=self.dtype)
+            buffer._data[:len(rows)] = self._data[rows]
+            buffer._size = len(rows)
+        return buffer
+
+    def save(self, path):
+        np.save(path, self.view())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''load a saved column, memory-mapped read-only unless written to'''
+        data = np.load(path, mmap_mode='r' if mmap else None)
+        buffer = cls(data.dtype)
+        buffer.row_shape = data.shape[1:]
+        buffer._data = data
+        buffer._size = len(data)
+        return buffer
+
+class RecordCollection:
+    ''' training records keyed by message id (O(1) lookup), oldest first.
+        the numeric fields (features, embeddings, labels) live in ColumnBuffers, the
+        record dict only keeps the metadata plus its 'row'. snapshot() hands out a copy
+        of the columns as matrices for training.
+        retention: above max_size the oldest records without feedback are evicted
+        first, records with feedback only go once the hard cap (2x) is hit.
+        thread safe: user messages are added on the inference thread, bot responses and
+        feedback on the event loop. every read and write of the buffers (add, update,
+        value, snapshot, compaction) is under one lock; membership checks are plain
+        dict lookups.
+    '''
+    def __init__(self, columns, max_size=50000):
+        self.max_size = max_size
+        self.columns = {name: ColumnBuffer(dtype) for name, dtype in columns.items()}
+        self._records = OrderedDict()      # key -> record
+        self._no_feedback = OrderedDict()  # keys without feedback yet, oldest first
+        self._dead = 0                     # rows of evicted records, reclaimed by _compact
+        self._lock = threading.Lock()      # records come in from the event loop and the inference thread
+        self.evicted = 0
+
+    def add(self, key, record):
+        record = dict(record)
+        with self._lock:
+            if key in self._records: self._drop(key, evicted=False)
+            row = None
+            for name, column in self.columns.items(): row = column.append(record.pop(name))
+            record['row'] = row
+            self._records[key] = record
+            self._no_feedback[key] = None
+            self._evict()
+
+    def get(self, key):
+        '''metadata of a record (numeric fields through value())'''
+        return self._records.get(key)
+
+    def value(self, key, column):
+        with self._lock:
+            return self.columns[column][self._records[key]['row']]
+
+    def update(self, key, **values):
+        '''set numeric fields of a record. counts as feedback: keeps it around longer'''
+        with self._lock:
+            row = self._records[key]['row']
+            for name, value in values.items(): self.columns[name][row] = value
+            self._no_feedback.pop(key, None)
+
+    def require_shape(self, column, row_shape):
+        '''drop all records if their column has a different row shape (e.g. old feature set)'''
+        with self._lock:
+            current = self.columns[column].row_shape
+            if current is None or current == tuple(row_shape): return
+            print(f"Dropping {len(self._records)} records with {column} of shape {current}, expected {tuple(row_shape)}")
+            self.columns = {name: ColumnBuffer(buffer.dtype) for name, buffer in self.columns.items()}
+            self._records.clear()
+            self._no_feedback.clear()
+            self._dead = 0
+
+    def _drop(self, key, evicted=True):
+        self._records.pop(key)
+        self._no_feedback.pop(key, None)
+        self._dead += 1
+        self.evicted += evicted
+
+    def _evict(self):
+        while len(self._records) > self.max_size and self._no_feedback:
+            self._drop(next(iter(self._no_feedback)))
+        while len(self._records) > 2 * self.max_size:
+            self._drop(next(iter(self._records)))
+        if self._dead > max(1024, len(self._records)): self._compact()
+
+    def _compact(self):
+        '''drop the rows of evicted records, so rows line up with the records again'''
+        rows = np.fromiter((r['row'] for r in self._records.values()), dtype=np.int64, count=len(self._records))
+        self.columns = {name: column.take(rows) for name, column in self.columns.items()}
+        for row, record in enumerate(self._records.values()): record['row'] = row
+        self._dead = 0
+
+    def snapshot(self):
+        ''' (records, {column: matrix}) with matrix row i belonging to records[i]. copied under
+            the lock: feedback coming in while training reads it can't change it halfway
+        '''
+        with self._lock:
+            if self._dead: self._compact()
+            return [dict(record) for record in self._records.values()], {name: column.view().copy() for name, column in self.columns.items()}
+
+    def export(self):
+        '''full records, metadata and numeric fields joined back together'''
+        records, columns = self.snapshot()
+        return [dict(record, **{name: matrix[i] for name, matrix in columns.items()}) for i, record in enumerate(records)]
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+class TrainingStore:
+    ''' training data, split by type:
+        respond_requests: user messages, keyed by message_id (respond classifier)
+        bot_responses: bot replies, keyed by bot_message_id (choice embeddings)
+    '''
+    def __init__(self, max_records=50000):
+        self.respond_requests = RecordCollection({'features': np.float64, 'should_respond': np.int8, 'timestamp': np.float64}, max_records)
+        self.bot_responses = RecordCollection({'original_embedding': np.float32, 'feedback_score': np.float32}, max_records)
+
+    def add_respond_request(self, record):
+        self.respond_requests.add(record['message_id'], record)
+
+    def add_bot_response(self, record):
+        self.bot_responses.add(record['bot_message_id'], record)
+
+    def stats(self):
+        return {
+            'respond_requests': len(self.respond_requests),
+            'bot_responses': len(self.bot_responses),
+            'evicted': self.respond_requests.evicted + self.bot_responses.evicted
+        }
@@ -1,141 +1,329 @@
+import time
+import asyncio
+import multiprocessing
 import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from embed_index import EmbeddingIndex
+import data
+from response_sys import migrate_features
+from metrics import metrics
+
+def training_pool():
+    ''' the training process. spawned, not forked: by the time it starts the bot has the
+        inference and log writer threads running (and maybe the model loaded), which a
+        forked child would inherit mid-lock
+    '''
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+def apply_choice_feedback(embeddings, records, inputs, feedback, learning_rate, chunk_cells=2**21):
+    ''' move response embeddings toward (good feedback) or away from (bad feedback) the
+        message that triggered them: the response itself by learning_rate, the other
+        responses in its category by half that. datapoints are applied in order.
+
+        done per category as matrix operations on the EmbeddingIndex instead of one
+        datapoint at a time. a row's update e <- e + s*a*(x - e) is affine, so all K
+        updates compose to e_K = prod(c)*e_0 + sum_k prod(c_j, j>k)*d_k*x_k with
+        d = s*a and c = 1 - d; this gives the same result as the sequential loop.
+        datapoints are processed in chunks of at most chunk_cells (rows x datapoints).
+    '''
+    # datapoints that apply: nonzero feedback on a response that still exists
+    targets = np.array([embeddings.row(r['response_id']) if r['response_id'] in embeddings else -1 for r in records], dtype=np.int64)
+    by_category = defaultdict(list)
+    for i in np.flatnonzero((np.asarray(feedback) != 0) & (targets >= 0)):
+        by_category[records[i]['response_id'][0]].append(i)
+    if not by_category: return
+
+    # category -> rows of its responses
+    category_rows = defaultdict(list)
+    for row, response_id in enumerate(embeddings.ids): category_rows[response_id[0]].append(row)
+
+    for category, points in by_category.items():
+        points = np.array(points)
+        members = np.array(category_rows[category])  # ascending
+        target_pos = np.searchsorted(members, targets[points])
+        signs = np.where(np.asarray(feedback)[points] > 0, 1.0, -1.0)
+        current = embeddings.matrix[members].astype(np.float64)
+
+        step = max(1, chunk_cells // len(members))
+        for start in range(0, len(points), step):
+            chunk = slice(start, start + step)
+            n = len(points[chunk])
+            # per row, per datapoint: d = s*a, c = 1 - d
+            d = np.full((len(members), n), 0.5 * learning_rate)
+            d[target_pos[chunk], np.arange(n)] = learning_rate
+            d *= signs[chunk]
+            # suffix products of c: how much of each datapoint's update survives the later ones
+            survive = np.cumprod((1 - d)[:, ::-1], axis=1)[:, ::-1]
+            after = np.concatenate([survive[:, 1:], np.ones((len(members), 1))], axis=1)
+            current = survive[:, :1] * current + (after * d) @ inputs[points[chunk]].astype(np.float64)
+
+        embeddings.set_rows(members, current)
+
+def run_training(job):
+    ''' one training run on a snapshot, in the training process: fits the response
+        classifier, updates the choice embeddings and saves the models. returns the new
+        objects for the bot to swap in, plus timings.
+    '''
+    timings = {}
+    start = time.perf_counter()
+    config = job['config']
+    data_manager = data.DataManager(dict(config, feedback_log=0))  # files only, no log
+    trainer = TrainingManager(config, data_manager)
+    trainer.state = job['state']
+
+    # response system
+    response_system = SimpleNamespace(response_classifier=job['classifier'], feature_scaler=job['scaler'])
+    history = trainer._train_response_system(response_system, (None, job['respond_columns']))
+    timings['response'] = time.perf_counter() - start
+
+    # choice system
+    start = time.perf_counter()
+    embeddings = EmbeddingIndex.from_matrix(job['embedding_ids'], job['embeddings'])
+    choice_records, choice_columns = job['choice_data']
+    apply_choice_feedback(
+        embeddings, choice_records, choice_columns['original_embedding'],
+        choice_columns['feedback_score'], config.get('learning_rate', 0.1)
+    )
+    timings['choice'] = time.perf_counter() - start
+
+    # save
+    start = time.perf_counter()
+    data_manager.save_models(
+        response_system.response_classifier, response_system.feature_scaler, embeddings, history, trainer.state, job['base']
+    )
+    timings['save'] = time.perf_counter() - start
+
+    return {
+        'classifier': response_system.response_classifier,
+        'scaler': response_system.feature_scaler,
+        'state': trainer.state,
+        'embedding_ids': embeddings.ids,
+        'embeddings': embeddings.matrix,
+        'timings': timings
+    }
 
 class TrainingManager():
-    def __init__(self, config, data_manager):
+    def __init__(self, config, data_manager, inference=None, pool=None, previous=None):
         self.config = config
         self.data_manager = data_manager
+        self.inference = inference  # InferenceExecutor for swapping models in, None: swap directly
+        self.online = config.get('response_training', 'batch') == 'online'
+        self.state = previous.state if previous is not None else data_manager.load_training_state()
 
-    async def training_loop(self, response_system, choice_system, message=None):
-        '''Periodic training of both systems'''
-        training_data = self.data_manager.training_data
-        
-        # separate data types
-        response_data = [d for d in training_data if d['type'] == 'respond_request']
-        choice_data = [d for d in training_data if d['type'] == 'bot_response']
+        # background training: one run at a time, requests during a run coalesce into one rerun
+        self._pool = pool  # training process, shared between guilds when given
+        self._own_pool = pool is None
+        # the run in progress, shared with reloaded TrainingManagers (manager: the newest one)
+        self._run = SimpleNamespace(task=None, rerun=False, runs=0, last_duration=None, manager=self)
+
+        # hot reload: keep the training process, and a run that's still going
+        if previous is not None:
+            self._pool, self._own_pool = previous._pool, previous._own_pool
+            self._run = previous._run
+            self._run.manager = self
+            previous._own_pool = False
+
+    @property
+    def running(self):
+        return self._run.task is not None and not self._run.task.done()
+
+    @property
+    def runs(self):
+        return self._run.runs
+
+    @property
+    def last_duration(self):
+        return self._run.last_duration
+
+    async def training_loop(self, context, message=None):
+        '''Periodic training of both systems of a context (OCKYBot or GuildContext), in a separate
+           process. if a run is already going, this request is merged into a single run after it'''
+        if self.running:
+            print("Training already running, queued one more run")
+            self._run.rerun = True
+            if message: await message.channel.send("Ik ben al aan het trainen, daarna train ik nog een keer!")
+            return await asyncio.shield(self._run.task)
+
+        self._run.task = asyncio.ensure_future(self._training_runs(context, message))
+        return await asyncio.shield(self._run.task)
+
+    async def _training_runs(self, context, message):
+        run = self._run
+        await self._training_run(context, message)
+        while run.rerun:
+            run.rerun = False
+            await run.manager._training_run(context, None)  # after a reload: the new code
+
+    async def _run_inference(self, fn, *args):
+        if self.inference is None: return fn(*args)
+        return await self.inference.run(fn, *args)
+
+    async def _training_run(self, context, message=None):
+        ''' one training run: snapshot, train in the background, swap the results in. the
+            systems are looked up in the context each time: a reload can replace them mid-run
+        '''
+        start = time.perf_counter()
+        response_system, choice_system = context.response_system, context.choice_system
+
+        # snapshot both data types: (records, {column: matrix}), with the latest votes in
+        context.data_manager.flush_feedback()
+        response_data = context.data_manager.store.respond_requests.snapshot()
+        choice_data = context.data_manager.store.bot_responses.snapshot()
+        n_response, n_choice = len(response_data[0]), len(choice_data[0])
 
         # check if we have too little data to train
-        if (len(response_data) < 10) or (len(choice_data) < 10):
-            print(f"not enough data! response:{len(response_data)}, choice:{len(choice_data)} < 10 each")
+        if (n_response < 10) or (n_choice < 10):
+            print(f"not enough data! response:{n_response}, choice:{n_choice} < 10 each")
             return
 
         # start training message
         print("Training Loop Started!")
-        if message: status = await message.channel.send(f"Aan het trainen op {len(response_data)} feedback points...")
-        
-        # train systems
-        response_data = self._train_response_system(response_system, response_data)
-        self._train_choice_system(choice_system, choice_data)
-        
-        # save models
-        self.data_manager.save_models(
-            response_system.response_classifier,
-            response_system.feature_scaler,
-            choice_system.response_embeddings,
-            response_data
-        )
-        self._train_stats(choice_system)
+        if message: status = await message.channel.send(f"Aan het trainen op {n_response} feedback points...")
+
+        # train in the training process on a copy of everything it needs. the checkpoint
+        # version goes first: an embedding added after it is merged back in on save. the
+        # embeddings are copied on the inference thread, where responses get added
+        latest = context.data_manager.checkpoints.latest()
+        embeddings = choice_system.response_embeddings
+        embedding_ids, embedding_matrix = await self._run_inference(lambda: (list(embeddings.ids), embeddings.matrix.copy()))
+        job = {
+            'base': latest.version if latest is not None else None,
+            'config': self.config,
+            'state': dict(self.state),
+            'classifier': response_system.response_classifier,
+            'scaler': response_system.feature_scaler,
+            'respond_columns': response_data[1],
+            'choice_data': ([{'response_id': r['response_id']} for r in choice_data[0]], choice_data[1]),
+            'embedding_ids': embedding_ids,
+            'embeddings': embedding_matrix
+        }
+        try:
+            result = await self._run_in_background(job)
+        except Exception as e:
+            print(f"Training error: {e}")
+            if message: await status.edit(content=f"Training mislukt: {e}")
+            return
+
+        # hot swap the new models in, on the inference thread (so never halfway a prediction)
+        await self._run_inference(self._swap, context, result)
+        self.state.update(result['state'])  # in place: shared with a reloaded TrainingManager
+        context.data_manager.compact_log()
+        await self._run_inference(lambda: self._train_stats(context.choice_system, response_data))
 
         # end training message
-        print("Training update complete!")
-        if message: 
-            await status.edit(content=f"Training afgerond!")
-    
+        duration = time.perf_counter() - start
+        self._run.runs += 1
+        self._run.last_duration = duration
+        metrics.observe('ocky_training_seconds', duration)
+        timings = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result['timings'].items())
+        print(f"Training update complete! ({duration:.2f}s: {timings})")
+        if message:
+            await status.edit(content=f"Training afgerond! ({duration:.1f}s)")
+
+    async def _run_in_background(self, job):
+        '''run_training in the training process (or the inference thread with training_process 0)'''
+        if self.config.get('training_process', 1) != 1:
+            return await self._run_inference(run_training, job)
+        if self._pool is None: self._pool = training_pool()
+        return await asyncio.get_running_loop().run_in_executor(self._pool, run_training, job)
+
+    def _swap(self, context, result):
+        '''(on the inference thread, like reloads) into the context's current systems'''
+        context.response_system.response_classifier = result['classifier']
+        context.response_system.feature_scaler = result['scaler']
+        context.choice_system.swap_embeddings(result['embedding_ids'], result['embeddings'])
+
+    def shutdown(self):
+        if self._pool is not None and self._own_pool: self._pool.shutdown(wait=False, cancel_futures=True)
+
     def _train_response_system(self, response_system, datapoints):
-        '''Train the response classifier'''
-        X, y = [], []
-        # load old data
-        for data in self.data_manager.load_response_training_data():
-                X.append(data['features'])
-                y.append(data['should_respond'])
-
-        # new data
-        for data in datapoints:
-            if 'features' in data and 'should_respond' in data:
-                X.append(data['features'])
-                y.append(data['should_respond'])
+        ''' Train the response classifier on the respond requests it hasn't learned from yet.
+            a request only counts as learned once its feedback window (feedback_window
+            seconds for a 🗣️ reaction) has passed, everything up to then is kept in
+            learned_until.
+            online: partial_fit scaler and classifier on just the new data.
+            batch: refit on all saved history plus the new data (returns the new history).
+        '''
+        _, columns = datapoints
+        features, labels, timestamps = columns['features'], columns['should_respond'], columns['timestamp']
+
+        # rows are in arrival order: new = after learned_until, mature = feedback window passed
+        first_new = np.searchsorted(timestamps, self.state['learned_until'], side='right')
+        mature_end = np.searchsorted(timestamps, time.time() - self.config.get('feedback_window', 600), side='right')
+        mature_end = max(first_new, mature_end)
+
+        if self.online:
+            X, y = features[first_new:mature_end], labels[first_new:mature_end]
+            if len(X) == 0:
+                print("No new response training data")
+                return None
+            response_system.feature_scaler.partial_fit(X)
+            response_system.response_classifier.partial_fit(
+                response_system.feature_scaler.transform(X), y, classes=np.array([0, 1])
+            )
+            self.state['learned_until'] = float(timestamps[mature_end - 1])
+            print(f"Online update on {len(X)} new response datapoints")
+            return None
+
+        # batch: old data + everything new
+        X_old, y_old = self.data_manager.load_response_training_data()
+        if len(X_old) and X_old.ndim == features.ndim == 2: X_old = migrate_features(X_old, features.shape[1])
+        if len(X_old) and X_old.shape[1:] == features.shape[1:]:
+            X = np.concatenate([X_old, features[first_new:]])
+            y = np.concatenate([y_old, labels[first_new:]])
+            history = np.concatenate([X_old, features[first_new:mature_end]]), np.concatenate([y_old, labels[first_new:mature_end]])
+        else:
+            X, y = features[first_new:], labels[first_new:]
+            history = features[first_new:mature_end], labels[first_new:mature_end]
 
         if len(X) < 2:
             print("Not enough response training data")
             return
 
-        X = np.array(X)
-        y = np.array(y)
-        
         # scale only if no scale yet
         if not hasattr(response_system.feature_scaler, 'scale_'):
               X_scaled = response_system.feature_scaler.fit_transform(X)
         else: X_scaled = response_system.feature_scaler.transform(X)
         response_system.response_classifier.fit(X_scaled, y) # fit
 
-        # update training data
-        return [{'features':f,'should_respond':sr} for f,sr in list(zip(X,y))[-1000:]]
+        # update training data: history now holds every mature datapoint
+        if mature_end > first_new: self.state['learned_until'] = float(timestamps[mature_end - 1])
+        return history
+
+    def online_update(self, response_system):
+        '''cheap in-between update of the response classifier (online mode only)'''
+        if not self.online or self.running: return
+        learned_until = self.state['learned_until']
+        self._train_response_system(response_system, self.data_manager.store.respond_requests.snapshot())
+        if self.state['learned_until'] != learned_until:
+            self.data_manager.save_checkpoint(
+                classifier=response_system.response_classifier, scaler=response_system.feature_scaler, state=self.state
+            )
 
     def _train_choice_system(self, choice_system, datapoints):
         '''update response embeddings based on feedback'''
-        learning_rate = self.config.get('learning_rate', 0.1)
-        
-        for data in datapoints:
-            if data['feedback_score'] == 0: continue
-
-            response_id = data['response_id']
-            feedback = data['feedback_score']
-            input_embedding = data['original_embedding']
-            
-            if response_id not in choice_system.response_embeddings: continue
-
-            # update specific response
-            current_embedding = choice_system.response_embeddings[response_id]
-            mu = learning_rate * (input_embedding - current_embedding)
-
-            # give feedback by adding/subtracting mu from embedding
-            if feedback > 0: choice_system.response_embeddings[response_id] = current_embedding + mu
-            else: choice_system.response_embeddings[response_id] = current_embedding - mu
-
-            # update others in same category
-            category_learning_rate = learning_rate * 0.5
-            target_category = response_id[0]
-
-            for other_response_id in choice_system.response_embeddings:
-                if (other_response_id[0] != target_category): continue # other category
-                if (other_response_id == response_id): continue # original response
-
-                other_embedding = choice_system.response_embeddings[other_response_id]
-                mu = category_learning_rate * (input_embedding - other_embedding)
-
-                # give feedback by adding/subtracting mu from embedding
-                if feedback > 0: choice_system.response_embeddings[other_response_id] = other_embedding + mu
-                else: choice_system.response_embeddings[other_response_id] = other_embedding - mu
+        records, columns = datapoints
+        apply_choice_feedback(
+            choice_system.response_embeddings, records,
+            columns['original_embedding'], columns['feedback_score'],
+            self.config.get('learning_rate', 0.1)
+        )
 
-    def _train_stats(self, choice_system):
+    def _train_stats(self, choice_system, respond_data):
         # training data breakdown
-        respond_data = [d for d in self.data_manager.training_data if d['type'] == 'respond_request']
-        positive = sum(1 for d in respond_data if d['should_respond'] == 1)
-        negative = sum(1 for d in respond_data if d['should_respond'] == 0)
+        labels = respond_data[1]['should_respond']
+        positive = int(np.count_nonzero(labels == 1))
+        negative = int(np.count_nonzero(labels == 0))
         
         if negative > 0:
               ratio = positive / negative
-              print(f"{len(respond_data)} Training Feedback Points: ({ratio:.4f} POS/NEG ratio)")
-        else: print(f"{len(respond_data)} Training Feedback Points: ({positive} positive, {negative} negative)")
+              print(f"{len(labels)} Training Feedback Points: ({ratio:.4f} POS/NEG ratio)")
+        else: print(f"{len(labels)} Training Feedback Points: ({positive} positive, {negative} negative)")
 
         # embedding drift (how much embeddings changed from original)
-        total_drift = 0
-        drift_count = 0
-        
-        for resp_id, curr_embed in choice_system.response_embeddings.items():
-            if resp_id not in choice_system.response_dict: 
-                continue # skip if not in dict
-                
-            original_text = choice_system.response_dict[resp_id]
-            original_embed = choice_system.sentence_model.encode(original_text)
-
-            # calculate cosine distance between embeddings
-            similarity = np.dot(curr_embed, original_embed) / (
-                np.linalg.norm(curr_embed) * np.linalg.norm(original_embed)
-            )
-            drift = 1 - similarity
-            total_drift += drift
-            drift_count += 1
-        
-        if drift_count > 0:
-            avg_drift = total_drift / drift_count
-            print(f"Embedding Drift: {avg_drift:.4f}")
\ No newline at end of file
+        avg_drift, category_drift = choice_system.embedding_drift()
+        if avg_drift is not None:
+            print(f"Embedding Drift: {avg_drift:.4f}")
+            print("  " + ", ".join(f"{category}: {drift:.4f}" for category, drift in sorted(category_drift.items())))
@@ -1,27 +1,263 @@
-from sentence_transformers import SentenceTransformer
+from collections import OrderedDict
+import numpy as np
+import time
 import gc
+import os
+from metrics import metrics
+from disk_cache import DiskEmbeddingCache
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def process_rss_mb():
+    '''resident memory of this process in MB, None if it can't be measured here'''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def load_sentence_transformer(model_name):
+    # imported here: torch is only pulled into memory once a model is actually needed
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def load_torch_int8(model_name):
+    '''pytorch model with its Linear layers dynamically quantized to int8 (CPU)'''
+    import torch
+    model = load_sentence_transformer(model_name)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_onnx(model_name, export_dir, quantization=None):
+    ''' ONNX Runtime model, exported once into export_dir and loaded from there after.
+        quantization ('avx2', 'avx512', 'arm64', ...): int8 dynamic quantized export
+    '''
+    from sentence_transformers import SentenceTransformer
+    local = os.path.join(export_dir, model_name.replace('/', '--') + '-onnx')
+    if not os.path.exists(os.path.join(local, 'onnx', 'model.onnx')):
+        print(f"Exporting {model_name} to ONNX in {local}")
+        SentenceTransformer(model_name, backend='onnx').save_pretrained(local)
+    if quantization is None: return SentenceTransformer(local, backend='onnx')
+
+    file_name = f'onnx/model_qint8_{quantization}.onnx'
+    if not os.path.exists(os.path.join(local, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        print(f"Quantizing {model_name} ONNX export for {quantization}")
+        export_dynamic_quantized_onnx_model(SentenceTransformer(local, backend='onnx'), quantization, local)
+    return SentenceTransformer(local, backend='onnx', model_kwargs={'file_name': file_name})
+
+# encoder_backend config -> how to load it. all give (near) the same embeddings as 'torch',
+# check with: python source/benchmark.py encoders
+ENCODER_BACKENDS = ['torch', 'torch-int8', 'onnx', 'onnx-int8']
+
+def make_model_factory(backend='torch', export_dir='source/models/encoders', quantization='avx2'):
+    '''model_name -> model function for RAMTransformer'''
+    if backend == 'torch': return load_sentence_transformer
+    if backend == 'torch-int8': return load_torch_int8
+    if backend == 'onnx': return lambda model_name: load_onnx(model_name, export_dir)
+    if backend == 'onnx-int8': return lambda model_name: load_onnx(model_name, export_dir, quantization)
+    raise ValueError(f"unknown encoder backend {backend!r}, expected one of {ENCODER_BACKENDS}")
+
+def encoder_factory(config):
+    '''make_model_factory for config encoder_backend, exports go in models_dir/encoders'''
+    return make_model_factory(
+        config.get('encoder_backend', 'torch'),
+        os.path.join(config.get('models_dir', 'source/models'), 'encoders'),
+        config.get('encoder_quantization', 'avx2')
+    )
+
+def make_sentence_model(config, model_factory=None, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
+    '''the RAMTransformer the config asks for, with its disk cache (disk_cache_size 0: none)'''
+    disk_cache = None
+    if config.get('disk_cache_size', 10000):
+        backend = config.get('encoder_backend', 'torch') if model_factory is None else 'custom'
+        disk_cache = DiskEmbeddingCache(
+            os.path.join(config.get('models_dir', 'source/models'), 'embedding_cache', f"{model_name.replace('/', '--')}-{backend}"),
+            config.get('disk_cache_size', 10000)
+        )
+    return RAMTransformer(
+        model_name,
+        cache_size=config.get('embedding_cache_size', 1024),
+        ram_friendly=config.get('ram_friendly', 1) == 1,
+        idle_timeout=config.get('model_idle_timeout', 300),
+        max_rss_mb=config.get('model_max_rss_mb'),
+        model_factory=model_factory or encoder_factory(config),
+        disk_cache=disk_cache
+    )
+
+class EmbeddingCache:
+    ''' bounded LRU cache of text -> embedding, so the same message text is
+        only pushed through the model once (also across messages, "hoi" "lol" etc.)
+    '''
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        '''return cached embedding or None'''
+        embedding = self._data.get(text)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(text)
+        self.hits += 1
+        return embedding
+
+    def put(self, text, embedding):
+        '''store embedding, evicting the least recently used one if full'''
+        if self.max_size <= 0: return
+        embedding.setflags(write=False) # shared between callers: never modify in place
+        self._data[text] = embedding
+        self._data.move_to_end(text)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+    def __len__(self):
+        return len(self._data)
 
 class RAMTransformer:
-    ''' stand-in for the SentenceTransformer class that loads/unloads 
-        SentenceTransformer so it's only in RAM when needed
+    ''' stand-in for the SentenceTransformer class that loads/unloads
+        SentenceTransformer so it's only in RAM when needed.
+        residency: with ram_friendly the model stays warm between messages and is
+        only unloaded after idle_timeout seconds without use, or when the process
+        goes over max_rss_mb. without ram_friendly it stays loaded.
     '''
-    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
+    # encode kwargs that don't change the output, anything else skips the cache
+    CACHE_SAFE_KWARGS = {'batch_size', 'show_progress_bar'}
+
+    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2', cache_size=1024,
+                 ram_friendly=True, idle_timeout=300, max_rss_mb=None, model_factory=None, disk_cache=None):
         self.model_name = model_name
+        self.model_factory = model_factory or load_sentence_transformer  # model_name -> model with .encode
         self._model = None
-    
+        self.cache = EmbeddingCache(cache_size)
+        self.disk_cache = disk_cache  # DiskEmbeddingCache for encode(..., persist=True), or None
+
+        # residency policy
+        self.ram_friendly = ram_friendly
+        self.idle_timeout = idle_timeout
+        self.max_rss_mb = max_rss_mb
+        self.last_used = 0.0
+
+        # stats
+        self.load_count = 0
+        self.unload_count = 0
+        self.load_time = 0.0
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
     def _load_model(self):
         '''load model if not already loaded'''
+        self.last_used = time.time()
         if self._model is None:
-            self._model = SentenceTransformer(self.model_name)
-    
-    def encode(self, sentences, **kwargs):
-        '''load model if needed and encode'''
-        self._load_model()
-        return self._model.encode(sentences, **kwargs)
-    
+            start = time.perf_counter()
+            self._model = self.model_factory(self.model_name)
+            self.load_time += time.perf_counter() - start
+            self.load_count += 1
+            metrics.observe('ocky_model_load_seconds', time.perf_counter() - start)
+
+    def encode(self, sentences, persist=False, **kwargs):
+        ''' encode through the embedding cache. loads model only on a cache miss.
+            persist: texts that don't change (responses, example inputs), also looked up
+            in / saved to the disk cache so restarts don't encode them again
+        '''
+        if not set(kwargs) <= self.CACHE_SAFE_KWARGS:
+            self._load_model()
+            with metrics.timer('ocky_encode_seconds'): return self._model.encode(sentences, **kwargs)
+        disk_cache = self.disk_cache if persist else None
+
+        # single sentence
+        if isinstance(sentences, str):
+            embedding = self.cache.get(sentences)
+            if embedding is None and disk_cache is not None:
+                embedding = disk_cache.get(sentences)
+                if embedding is not None: self.cache.put(sentences, embedding)
+            if embedding is None:
+                self._load_model()
+                with metrics.timer('ocky_encode_seconds'): embedding = self._model.encode(sentences, **kwargs)
+                self.cache.put(sentences, embedding)
+                if disk_cache is not None:
+                    disk_cache.put(sentences, embedding)
+                    disk_cache.flush()
+            return embedding
+
+        # list of sentences: only encode the (unique) misses, in one batch
+        sentences = list(sentences)
+        found = {}
+        missing = []
+        for sentence in sentences:
+            if sentence in found: continue
+            embedding = self.cache.get(sentence)
+            if embedding is None and disk_cache is not None:
+                embedding = disk_cache.get(sentence)
+                if embedding is not None: self.cache.put(sentence, embedding)
+            if embedding is None: missing.append(sentence)
+            found[sentence] = embedding
+        if missing:
+            self._load_model()
+            with metrics.timer('ocky_encode_seconds'): embeddings = self._model.encode(missing, **kwargs)
+            for sentence, embedding in zip(missing, embeddings):
+                embedding = np.array(embedding) # own copy, don't keep the whole batch alive
+                self.cache.put(sentence, embedding)
+                if disk_cache is not None: disk_cache.put(sentence, embedding)
+                found[sentence] = embedding
+            if disk_cache is not None: disk_cache.flush()
+        return np.array([found[sentence] for sentence in sentences])
+
+    def release(self):
+        '''caller is done with the model for now. only unloads right away if the
+           policy says so (no idle timeout, or memory pressure)'''
+        if not self.ram_friendly or self._model is None: return
+        if not self.idle_timeout or self._over_memory_limit():
+            self.unload()
+
+    def check_residency(self):
+        '''periodic check: unload when idle for too long or under memory pressure'''
+        if not self.ram_friendly or self._model is None: return
+        idle = time.time() - self.last_used
+        if (self.idle_timeout and idle > self.idle_timeout) or self._over_memory_limit():
+            print(f"unloading sentence model (idle {idle:.0f}s)")
+            self.unload()
+
+    def _over_memory_limit(self):
+        if not self.max_rss_mb: return False
+        rss = process_rss_mb()
+        return rss is not None and rss > self.max_rss_mb
+
+    def stats(self):
+        return {
+            'loaded': self.is_loaded,
+            'load_count': self.load_count,
+            'unload_count': self.unload_count,
+            'load_time': self.load_time,
+            'cache': self.cache.stats(),
+            'disk_cache': self.disk_cache.stats() if self.disk_cache is not None else None
+        }
+
     def unload(self):
         '''unload the model to free memory'''
         if self._model is not None:
             del self._model
             self._model = None
-            gc.collect()
\ No newline at end of file
+            self.unload_count += 1
+            gc.collect()